@@ -1,6 +1,7 @@
 from smbus2 import SMBus
 import time
 import socket
+import struct
 
 UDP_IP = "192.168.18.223"  # Replace with your laptop's IP
 UDP_PORT = 5005
@@ -12,6 +13,10 @@ MPU_ADDRS = [0x68, 0x69]
 PWR_MGMT_1 = 0x6B
 ACCEL_XOUT_H = 0x3B
 GYRO_XOUT_H = 0x43
+BURST_LEN = 14  # ACCEL_XOUT_H..GYRO_ZOUT_L, incl. temperature
+
+# "burst": one 14 byte block read per MPU, "word": 12 single byte reads per MPU
+READ_MODE = "burst"
 
 # Setup: Initialize each MPU on each bus
 i2c_buses = [0, 1]  # /dev/i2c-0 and /dev/i2c-1
@@ -36,6 +41,22 @@ def read_word(bus, addr, reg):
         val -= 0x10000
     return val
 
+def read_burst(bus, addr):
+    block = bus.read_i2c_block_data(addr, ACCEL_XOUT_H, BURST_LEN)
+    ax, ay, az, temp, gx, gy, gz = struct.unpack('>7h', bytes(block))
+    return ax, ay, az, gx, gy, gz
+
+def read_axes(bus, addr):
+    if READ_MODE == "burst":
+        return read_burst(bus, addr)
+    ax = read_word(bus, addr, ACCEL_XOUT_H)
+    ay = read_word(bus, addr, ACCEL_XOUT_H + 2)
+    az = read_word(bus, addr, ACCEL_XOUT_H + 4)
+    gx = read_word(bus, addr, GYRO_XOUT_H)
+    gy = read_word(bus, addr, GYRO_XOUT_H + 2)
+    gz = read_word(bus, addr, GYRO_XOUT_H + 4)
+    return ax, ay, az, gx, gy, gz
+
 def get_program_time():
     programtime = starttime - time.time()
     return programtime
@@ -54,12 +75,7 @@ try:
     while True:
         for bus_num, addr in mpus:
             bus = buses[bus_num]  # reuse opened bus
-            ax = read_word(bus, addr, ACCEL_XOUT_H)
-            ay = read_word(bus, addr, ACCEL_XOUT_H + 2)
-            az = read_word(bus, addr, ACCEL_XOUT_H + 4)
-            gx = read_word(bus, addr, GYRO_XOUT_H)
-            gy = read_word(bus, addr, GYRO_XOUT_H + 2)
-            gz = read_word(bus, addr, GYRO_XOUT_H + 4)
+            ax, ay, az, gx, gy, gz = read_axes(bus, addr)
             programtime = get_program_time()
             datasend = f"{addr}, {bus_num}, {programtime}, {ax}, {ay}, {az}, {gx}, {gy}, {gz}"
 
@@ -0,0 +1,161 @@
+"""Append-only binary capture files for the laptop receiver (UDPLaptop.py)
+
+One file per IMU, a 64 byte header followed by fixed size records:
+
+    header  magic b'ZNCAP', version, record size, addr, bus_num,
+            count (records written), created (unix time)
+    record  programtime f8, sendertime_ns i8, seq u4,
+            ax ay az gx gy gz i2, q0 q1 q2 q3 f4
+
+The writer maps the file and fills it in place, doubling the mapping when
+it is full, so memory use does not grow with the length of a recording.
+The count in the header is updated with every record, so a capture that
+was not closed properly can still be read up to its last record. On close
+the unused preallocated space is cut off.
+
+open_capture() gives the records as a read only structured np.memmap,
+slicing it only reads the pages that are touched.
+"""
+import os
+import time
+import numpy as np
+
+MAGIC = b'ZNCAP'
+VERSION = 1
+HEADER = np.dtype([
+    ('magic', 'S8'),
+    ('version', '<u4'),
+    ('record_size', '<u4'),
+    ('addr', '<u2'),
+    ('bus_num', '<u2'),
+    ('reserved0', '<u4'),
+    ('count', '<u8'),
+    ('created', '<f8'),
+    ('reserved1', 'V24'),
+])
+HEADER_SIZE = HEADER.itemsize  # 64
+RECORD = np.dtype([
+    ('programtime', '<f8'),
+    ('sendertime_ns', '<i8'),
+    ('seq', '<u4'),
+    ('ax', '<i2'), ('ay', '<i2'), ('az', '<i2'),
+    ('gx', '<i2'), ('gy', '<i2'), ('gz', '<i2'),
+    ('q0', '<f4'), ('q1', '<f4'), ('q2', '<f4'), ('q3', '<f4'),
+])
+
+
+def get_capture_filename(addr, bus_num):
+    return f"imu_{addr}_{bus_num}.imu"
+
+
+class CaptureWriter:
+    """Appends records to one capture file through a growable memory map"""
+
+    def __init__(self, filename, addr, bus_num, initial_records=65536):
+        self.filename = filename
+        self.count = 0
+        self.capacity = 0
+        self.mm = None
+        with open(filename, 'wb') as f:
+            header = np.zeros(1, HEADER)
+            header['magic'] = MAGIC
+            header['version'] = VERSION
+            header['record_size'] = RECORD.itemsize
+            header['addr'] = addr
+            header['bus_num'] = bus_num
+            header['created'] = time.time()
+            f.write(header.tobytes())
+        self._map(initial_records)
+
+    def _map(self, capacity):
+        """(Re)maps the file with room for capacity records"""
+        self._unmap()
+        with open(self.filename, 'r+b') as f:
+            f.truncate(HEADER_SIZE + capacity * RECORD.itemsize)
+        self.mm = np.memmap(self.filename, dtype=np.uint8, mode='r+')
+        self.header = self.mm[:HEADER_SIZE].view(HEADER)
+        self.records = self.mm[HEADER_SIZE:].view(RECORD)
+        self.capacity = capacity
+
+    def _unmap(self):
+        if self.mm is not None:
+            self.mm.flush()
+            # Every view has to go before the file can be resized (Windows)
+            del self.header, self.records
+            self.mm = None
+
+    def append(self, programtime, sendertime_ns, seq, ax, ay, az, gx, gy, gz, q0, q1, q2, q3):
+        if self.count == self.capacity:
+            self._map(self.capacity * 2)
+        self.records[self.count] = (programtime, sendertime_ns, seq,
+                                    ax, ay, az, gx, gy, gz, q0, q1, q2, q3)
+        self.count += 1
+        self.header['count'] = self.count
+
+    def flush(self):
+        """Writes the mapped pages to disk"""
+        if self.mm is not None:
+            self.mm.flush()
+
+    def close(self):
+        """Cuts the file down to the records actually written"""
+        if self.mm is None:
+            return
+        self._unmap()
+        with open(self.filename, 'r+b') as f:
+            f.truncate(HEADER_SIZE + self.count * RECORD.itemsize)
+
+
+class CapturePool:
+    """Keeps one CaptureWriter per IMU inside folder, created on first use"""
+
+    def __init__(self, folder, flush_interval=1.0):
+        self.folder = folder
+        self.flush_interval = flush_interval
+        self.last_flush = time.monotonic()
+        self.writers = {}
+
+    def get(self, addr, bus_num):
+        writer = self.writers.get((addr, bus_num))
+        if writer is None:
+            os.makedirs(self.folder, exist_ok=True)
+            filename = os.path.join(self.folder, get_capture_filename(addr, bus_num))
+            writer = self.writers[(addr, bus_num)] = CaptureWriter(filename, addr, bus_num)
+        return writer
+
+    def poll(self):
+        """Writes the mapped pages to disk every flush_interval seconds"""
+        now = time.monotonic()
+        if now - self.last_flush >= self.flush_interval:
+            self.last_flush = now
+            for writer in self.writers.values():
+                writer.flush()
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
+
+
+def read_header(filename):
+    header = np.fromfile(filename, dtype=HEADER, count=1)
+    if len(header) == 0 or header['magic'][0] != MAGIC:
+        raise ValueError(f"{filename} is not a capture file")
+    if header['version'][0] != VERSION or header['record_size'][0] != RECORD.itemsize:
+        raise ValueError(f"{filename}: unsupported capture version {header['version'][0]}")
+    return {name: header[name][0].item() for name in ('addr', 'bus_num', 'count', 'created')}
+
+
+def open_capture(filename):
+    """
+    Returns (header dict, records) with records a read only structured
+    array mapped onto the file, no data is read until it is used
+    """
+    header = read_header(filename)
+    # A capture that was not closed still has preallocated space behind count
+    available = (os.path.getsize(filename) - HEADER_SIZE) // RECORD.itemsize
+    count = min(header['count'], available)
+    if count == 0:
+        return header, np.zeros(0, RECORD)
+    records = np.memmap(filename, dtype=RECORD, mode='r', offset=HEADER_SIZE, shape=(count,))
+    return header, records
@@ -0,0 +1,97 @@
+"""Clock synchronisation between a Pi and the laptop
+
+The laptop pings the Pi over the data port (see IMUProtocol.encode_sync).
+Every echo gives one NTP style measurement:
+
+    offset = ((t2 - t1) + (t3 - t4)) / 2    Pi clock minus laptop clock
+    delay  = (t4 - t1) - (t3 - t2)          network round trip
+
+Wi-Fi delays are very uneven, so only the measurements with the lowest
+delay in the recent window are used, and a straight line through them
+gives both the offset and the drift of the Pi clock.
+
+The estimate changes at the first echo (before it only the arrival of the
+first packet is known) and with every refit. to_session() never applies
+such a change as a step: the offset it uses moves towards the estimate by
+at most MAX_SLEW ns per ns of Pi time, so converted times keep increasing
+with the Pi's stamps.
+"""
+from collections import deque
+
+import numpy as np
+
+MAX_SLEW = 0.01  # ns of offset correction per ns of Pi time, 10 ms per second
+
+
+class ClockSync:
+
+    def __init__(self, window=64, best_fraction=0.5, max_slew=MAX_SLEW):
+        self.measurements = deque(maxlen=window)  # (local time, offset, delay) in ns
+        self.best_fraction = best_fraction
+        self.reference = None
+        self.offset = None  # ns at self.reference
+        self.drift = 0.0  # ns of offset change per ns of local time
+        self.delay = None
+        self.initial_offset = None
+        self.max_slew = max_slew
+        self.applied_offset = None  # ns, Pi minus laptop as used by to_session()
+        self.last_remote = None  # newest Pi stamp converted by to_session()
+
+    @property
+    def synced(self):
+        return self.offset is not None
+
+    def add(self, t1, t2, t3, t4):
+        """
+        Adds one ping: t1/t4 laptop send/receive, t2/t3 Pi receive/send,
+        all time.monotonic_ns() on their own machine
+        """
+        delay = (t4 - t1) - (t3 - t2)
+        offset = ((t2 - t1) + (t3 - t4)) / 2
+        self.measurements.append(((t1 + t4) / 2, offset, delay))
+        self._fit()
+
+    def observe(self, remote_ns, local_ns):
+        """
+        Rough offset from the first data packet, used until the first ping
+        came back (a sample arrives some ms after it was taken). It is not
+        refined afterwards so the early sample times stay in order
+        """
+        if self.initial_offset is None:
+            self.initial_offset = remote_ns - local_ns
+
+    def _fit(self):
+        measurements = sorted(self.measurements, key=lambda m: m[2])
+        best = measurements[:max(1, int(len(measurements) * self.best_fraction))]
+        local = np.array([m[0] for m in best])
+        offsets = np.array([m[1] for m in best])
+        self.reference = local.mean()
+        self.delay = best[0][2]
+        if len(best) >= 4 and np.ptp(local) > 0:
+            self.drift, self.offset = np.polyfit(local - self.reference, offsets, 1)
+        else:
+            self.drift, self.offset = 0.0, offsets.mean()
+
+    def to_local(self, remote_ns):
+        """Converts a Pi timestamp to the laptop clock (ns, float)"""
+        if self.offset is None:
+            if self.initial_offset is None:
+                return float(remote_ns)
+            return float(remote_ns - self.initial_offset)
+        # remote = local + offset + drift * (local - reference), solved for local
+        return (remote_ns - self.offset + self.drift * self.reference) / (1 + self.drift)
+
+    def to_session(self, remote_ns):
+        """
+        Converts a Pi timestamp to the laptop clock like to_local(), but
+        slews towards a new estimate instead of jumping to it
+        """
+        target = remote_ns - self.to_local(remote_ns)
+        if self.applied_offset is None:
+            self.applied_offset = target
+            self.last_remote = remote_ns
+        elif remote_ns > self.last_remote:
+            step = self.max_slew * (remote_ns - self.last_remote)
+            self.applied_offset += np.clip(target - self.applied_offset, -step, step)
+            self.last_remote = remote_ns
+        return float(remote_ns - self.applied_offset)
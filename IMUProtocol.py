@@ -0,0 +1,266 @@
+"""Binary UDP packet format shared by the Pi sender (QuadPi.py) and the laptop receiver (UDPLaptop.py)
+
+A datagram is one HEADER followed by `count` samples. Every sample is a
+fixed SAMPLE record, directly followed by a QUATERNION record when the
+header has FLAG_QUATERNION set. All fields are little endian.
+
+HEADER      magic b'ZN', version, flags, count
+SAMPLE      addr, bus_num, seq, timestamp_ns, ax, ay, az, gx, gy, gz (raw LSB)
+QUATERNION  q0, q1, q2, q3 (float32)
+
+timestamp_ns is the sender's time.monotonic_ns() of the sample. Clock
+synchronisation uses the same port: a packet with FLAG_SYNC and count 0
+carries one SYNC record instead of samples. The laptop sends it with t1
+filled in, the Pi echoes it straight back with t2 (receive) and t3 (send)
+on its own clock.
+
+SYNC        t1, t2, t3 (int64 ns)
+"""
+import struct
+import time
+from collections import namedtuple, deque
+
+MAGIC = b'ZN'
+VERSION = 1
+
+FLAG_QUATERNION = 0x01
+FLAG_SYNC = 0x02
+
+HEADER = struct.Struct('<2sBBH')
+SAMPLE = struct.Struct('<BBIq6h')
+QUATERNION = struct.Struct('<4f')
+SYNC = struct.Struct('<qqq')
+
+SEQ_MODULO = 1 << 32
+
+# Raw LSB scale of the MPU at its default full scale ranges (+-2 g, +-250 dps)
+ACC_LSB_PER_G = 16384
+GYRO_LSB_PER_DPS = 131
+
+Sample = namedtuple('Sample', ['addr', 'bus_num', 'seq', 'timestamp_ns',
+                               'ax', 'ay', 'az', 'gx', 'gy', 'gz', 'q'])
+
+
+class ProtocolError(ValueError):
+    """Raised when a datagram is not a valid packet"""
+
+
+def sample_size(flags):
+    """Number of bytes one sample takes for the given header flags"""
+    if flags & FLAG_QUATERNION:
+        return SAMPLE.size + QUATERNION.size
+    return SAMPLE.size
+
+
+def encode_packet(samples, flags=0):
+    """
+    Packs an iterable of Sample tuples into one datagram.
+    The q field is only written when flags has FLAG_QUATERNION
+    """
+    samples = list(samples)
+    packet = bytearray(HEADER.size + len(samples) * sample_size(flags))
+    HEADER.pack_into(packet, 0, MAGIC, VERSION, flags, len(samples))
+    offset = HEADER.size
+    for sample in samples:
+        SAMPLE.pack_into(packet, offset, *sample[:10])
+        offset += SAMPLE.size
+        if flags & FLAG_QUATERNION:
+            QUATERNION.pack_into(packet, offset, *sample.q)
+            offset += QUATERNION.size
+    return bytes(packet)
+
+
+def packet_flags(data):
+    """Checks the header of a datagram and returns its flags"""
+    if len(data) < HEADER.size:
+        raise ProtocolError(f"Packet too short ({len(data)} bytes)")
+    magic, version, flags, count = HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ProtocolError(f"Unknown magic {magic!r}")
+    if version != VERSION:
+        raise ProtocolError(f"Unsupported protocol version {version}")
+    return flags
+
+
+def encode_sync(t1, t2=0, t3=0):
+    """Packs a clock synchronisation ping (t1 only) or its echo (t1, t2, t3)"""
+    packet = bytearray(HEADER.size + SYNC.size)
+    HEADER.pack_into(packet, 0, MAGIC, VERSION, FLAG_SYNC, 0)
+    SYNC.pack_into(packet, HEADER.size, t1, t2, t3)
+    return bytes(packet)
+
+
+def decode_sync(data):
+    """Unpacks a clock synchronisation packet into (t1, t2, t3)"""
+    if not packet_flags(data) & FLAG_SYNC or len(data) != HEADER.size + SYNC.size:
+        raise ProtocolError("Not a sync packet")
+    return SYNC.unpack_from(data, HEADER.size)
+
+
+def decode_packet(data):
+    """Unpacks one datagram into a list of Sample tuples"""
+    flags = packet_flags(data)
+    if flags & FLAG_SYNC:
+        raise ProtocolError("Sync packet, use decode_sync")
+    magic, version, flags, count = HEADER.unpack_from(data, 0)
+    if len(data) != HEADER.size + count * sample_size(flags):
+        raise ProtocolError(f"Packet length {len(data)} does not match {count} samples")
+
+    samples = []
+    offset = HEADER.size
+    for _ in range(count):
+        fields = SAMPLE.unpack_from(data, offset)
+        offset += SAMPLE.size
+        q = None
+        if flags & FLAG_QUATERNION:
+            q = QUATERNION.unpack_from(data, offset)
+            offset += QUATERNION.size
+        samples.append(Sample(*fields, q))
+    return samples
+
+
+class BatchSender:
+    """
+    Collects samples and sends them as one datagram when max_samples are
+    waiting, when the datagram would exceed max_payload bytes or when the
+    oldest waiting sample is older than max_latency seconds
+    """
+
+    def __init__(self, sock, address, flags=0, max_samples=32, max_latency=0.005, max_payload=1472):
+        # 1472 = 1500 byte Ethernet/Wi-Fi MTU - 20 byte IP header - 8 byte UDP header
+        self.sock = sock
+        self.address = address
+        self.flags = flags
+        self.max_samples = min(max_samples, (max_payload - HEADER.size) // sample_size(flags))
+        self.max_latency = max_latency
+        self.samples = []
+        self.first_time = None
+
+    def add(self, sample):
+        """Queues one sample, sends the batch when it is full or too old"""
+        if not self.samples:
+            self.first_time = time.monotonic()
+        self.samples.append(sample)
+        if len(self.samples) >= self.max_samples:
+            self.flush()
+        else:
+            self.poll()
+
+    def poll(self):
+        """Sends the waiting samples if the oldest one is older than max_latency"""
+        if self.samples and self.time_until_flush() <= 0:
+            self.flush()
+
+    def time_until_flush(self):
+        """Seconds until the waiting samples have to go out, None if nothing is waiting"""
+        if not self.samples:
+            return None
+        return self.first_time + self.max_latency - time.monotonic()
+
+    def flush(self):
+        """Sends all waiting samples in one datagram"""
+        if not self.samples:
+            return
+        self.sock.sendto(encode_packet(self.samples, self.flags), self.address)
+        self.samples = []
+        self.first_time = None
+
+
+class SequenceTracker:
+    """
+    Follows the sequence numbers of one sensor stream and counts lost,
+    duplicated and reordered samples. A sample that arrives after a later
+    one was already seen first counts as lost and is moved to reordered
+    once it shows up.
+
+    With the sample's timestamp_ns, a restarted sender is told apart from
+    a duplicate: a duplicate repeats the stamp of the sample it copies, a
+    late (reordered) sample is older than the newest one seen. A sequence
+    number going back with a newer stamp, or with a stamp that does not
+    match the one seen before, is a restart
+    """
+
+    IN_ORDER = 'in_order'
+    GAP = 'gap'
+    DUPLICATE = 'duplicate'
+    REORDERED = 'reordered'
+    RESTART = 'restart'
+
+    def __init__(self, window=4096):
+        self.expected = None
+        self.received = 0
+        self.lost = 0
+        self.duplicates = 0
+        self.reordered = 0
+        self.restarts = 0
+        self.gaps = []  # (first missing seq, number missing)
+        self.window = window
+        self.recent = {}  # seq -> timestamp_ns (None if not given)
+        self.recent_order = deque()
+        self.last_timestamp = None  # stamp of the newest sample
+
+    def update(self, seq, timestamp_ns=None):
+        """Registers one sequence number (and its sender timestamp) and returns how it arrived"""
+        if self.expected is None:
+            status = self.IN_ORDER
+            self.expected = (seq + 1) % SEQ_MODULO
+        else:
+            ahead = (seq - self.expected) % SEQ_MODULO
+            if ahead == 0:
+                status = self.IN_ORDER
+                self.expected = (seq + 1) % SEQ_MODULO
+            elif ahead < SEQ_MODULO // 2:
+                status = self.GAP
+                self.lost += ahead
+                self.gaps.append((self.expected, ahead))
+                self.expected = (seq + 1) % SEQ_MODULO
+            elif self._is_restart(seq, timestamp_ns, SEQ_MODULO - ahead):
+                status = self.RESTART
+                self.restarts += 1
+                self.expected = (seq + 1) % SEQ_MODULO
+                # The old numbers mean nothing any more
+                self.recent.clear()
+                self.recent_order.clear()
+            elif seq in self.recent:
+                self.duplicates += 1
+                return self.DUPLICATE
+            else:
+                status = self.REORDERED
+                self.reordered += 1
+                self.lost -= 1
+
+        self.received += 1
+        if status != self.REORDERED and timestamp_ns is not None:
+            self.last_timestamp = timestamp_ns
+        self.recent[seq] = timestamp_ns
+        self.recent_order.append(seq)
+        if len(self.recent_order) > self.window:
+            self.recent.pop(self.recent_order.popleft(), None)
+        return status
+
+    def _is_restart(self, seq, timestamp_ns, behind):
+        """Whether a sequence number behind the expected one comes from a restarted sender"""
+        if timestamp_ns is not None:
+            if self.last_timestamp is not None and timestamp_ns > self.last_timestamp:
+                # Newer than everything seen, so not a late or repeated sample
+                return True
+            if seq in self.recent and self.recent[seq] not in (None, timestamp_ns):
+                # Same number, other sample (the sender's clock restarted too)
+                return True
+        if seq in self.recent:
+            return False
+        # Far behind anything we could still be waiting for
+        return behind > self.window
+
+    def stats(self):
+        """Counters as a dict, e.g. for a CSV row"""
+        total = self.received + self.lost
+        return {
+            'received': self.received,
+            'lost': self.lost,
+            'duplicates': self.duplicates,
+            'reordered': self.reordered,
+            'restarts': self.restarts,
+            'gaps': len(self.gaps),
+            'loss_pct': 100 * self.lost / total if total else 0.0
+        }
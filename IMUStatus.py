@@ -0,0 +1,68 @@
+"""Rate limited status line for the Pi sender and the laptop receiver
+
+Instead of printing every sample, the hot loops only bump counters. Every
+`interval` seconds one line is printed with the counters as rates (per
+second) and the gauges (queue depth, lag, totals) as their last value. On
+a terminal the line is rewritten in place, otherwise (e.g. output piped to
+a log file) every report is a new line.
+"""
+import sys
+import time
+
+
+class StatusLine:
+
+    def __init__(self, interval=1.0, stream=None):
+        self.interval = interval
+        self.stream = stream if stream is not None else sys.stdout
+        self.in_place = hasattr(self.stream, 'isatty') and self.stream.isatty()
+        self.counts = {}
+        self.gauges = {}
+        self.last_report = time.monotonic()
+        self.last_length = 0
+
+    def count(self, name, n=1):
+        """Adds n to a counter, reported as n per second"""
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def set(self, name, value):
+        """Sets a gauge, reported as is"""
+        self.gauges[name] = value
+
+    def due(self):
+        """True when the interval has passed, to update gauges just before report()"""
+        return time.monotonic() - self.last_report >= self.interval
+
+    def poll(self):
+        """Prints the status line if the interval has passed, cheap enough to call per sample"""
+        if self.due():
+            self.report()
+
+    def report(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        elapsed = max(now - self.last_report, 1e-9)
+        parts = [f"{name} {n / elapsed:.0f}/s" for name, n in sorted(self.counts.items(), key=str)]
+        parts += [f"{name} {_format(value)}" for name, value in sorted(self.gauges.items(), key=str)]
+        line = " | ".join(parts)
+        if self.in_place:
+            self.stream.write("\r" + line.ljust(self.last_length))
+            self.stream.flush()
+            self.last_length = len(line)
+        else:
+            print(line, file=self.stream)
+        self.counts = {name: 0 for name in self.counts}
+        self.last_report = now
+
+    def close(self):
+        """Ends the in place line so following prints start on a new line"""
+        if self.in_place and self.last_length:
+            self.stream.write("\n")
+            self.stream.flush()
+            self.last_length = 0
+
+
+def _format(value):
+    if isinstance(value, float):
+        return f"{value:.3f}"
+    return str(value)
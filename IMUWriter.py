@@ -0,0 +1,94 @@
+"""Buffered CSV writers for the laptop receiver (UDPLaptop.py)
+
+Every output file is opened once and kept open. Rows are collected in
+memory and written in one go when max_rows are waiting, when the oldest
+waiting row is older than max_age seconds, or on close.
+"""
+import csv
+import os
+import time
+
+
+class BufferedCSVWriter:
+    """Appends rows (dicts) to one CSV file, writes the header for a new file"""
+
+    def __init__(self, filename, fieldnames, max_rows=500, max_age=1.0):
+        file_exists = os.path.isfile(filename)
+        self.filename = filename
+        self.file = open(filename, mode='a', newline='')
+        self.writer = csv.DictWriter(self.file, fieldnames=fieldnames)
+        if not file_exists:
+            self.writer.writeheader()
+        self.max_rows = max_rows
+        self.max_age = max_age
+        self.rows = []
+        self.first_time = None
+
+    def writerow(self, row):
+        """Buffers one row, writes the buffer when it is full"""
+        if not self.rows:
+            self.first_time = time.monotonic()
+        self.rows.append(row)
+        if len(self.rows) >= self.max_rows:
+            self.flush()
+
+    def poll(self):
+        """Writes the buffer if the oldest row has waited longer than max_age"""
+        if self.rows and time.monotonic() - self.first_time >= self.max_age:
+            self.flush()
+
+    def age(self):
+        """Seconds the oldest buffered row has been waiting, 0 if none"""
+        if not self.rows:
+            return 0.0
+        return time.monotonic() - self.first_time
+
+    def flush(self):
+        """Writes all buffered rows to the file"""
+        if self.rows:
+            self.writer.writerows(self.rows)
+            self.file.flush()
+            self.rows = []
+            self.first_time = None
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+class CSVWriterPool:
+    """Keeps one BufferedCSVWriter per file name inside folder, opened on first use"""
+
+    def __init__(self, folder, max_rows=500, max_age=1.0):
+        self.folder = folder
+        self.max_rows = max_rows
+        self.max_age = max_age
+        self.writers = {}
+
+    def get(self, name, fieldnames):
+        """Writer for folder/name, created on first use"""
+        writer = self.writers.get(name)
+        if writer is None:
+            os.makedirs(self.folder, exist_ok=True)
+            writer = BufferedCSVWriter(os.path.join(self.folder, name), fieldnames,
+                                       self.max_rows, self.max_age)
+            self.writers[name] = writer
+        return writer
+
+    def poll(self):
+        """Writes every buffer that has been waiting longer than max_age"""
+        for writer in self.writers.values():
+            writer.poll()
+
+    def lag(self):
+        """Age of the oldest row that is not on disk yet"""
+        return max((writer.age() for writer in self.writers.values()), default=0.0)
+
+    def flush(self):
+        for writer in self.writers.values():
+            writer.flush()
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
@@ -1,21 +1,66 @@
-from smbus2 import SMBus
+from smbus2 import SMBus, i2c_msg
 from ahrs.filters import Madgwick
 import numpy as np
 import time
 import socket
+import struct
+import threading
+import queue
+import multiprocessing
+import IMUProtocol
+import IMUStatus
 
 UDP_IP = "192.168.18.223"  # Replace with your laptop's IP
 UDP_PORT = 5005
-starttime = time.time()
 sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-starttime = time.time()
-# Initialise Madgwick filter (quarternion to euler)
-madgwick_filter = Madgwick()
+sock.bind(("", 0))  # fixed source port, the laptop sends its clock pings back to it
 # MPU Registers
 MPU_ADDRS = [0x68, 0x69]
 PWR_MGMT_1 = 0x6B
 ACCEL_XOUT_H = 0x3B
 GYRO_XOUT_H = 0x43
+BURST_LEN = 14  # ACCEL_XOUT_H..GYRO_ZOUT_L, incl. temperature
+
+# FIFO registers
+SMPLRT_DIV = 0x19
+CONFIG = 0x1A
+FIFO_EN = 0x23
+INT_STATUS = 0x3A
+USER_CTRL = 0x6A
+FIFO_COUNTH = 0x72
+FIFO_R_W = 0x74
+FIFO_EN_ACCEL_GYRO = 0x78  # XG, YG, ZG and ACCEL into the FIFO (no temperature)
+USER_CTRL_FIFO_EN = 0x40
+USER_CTRL_FIFO_RESET = 0x04
+INT_FIFO_OFLOW = 0x10
+FIFO_FRAME_LEN = 12  # ax, ay, az, gx, gy, gz as big endian int16
+FIFO_READ_CHUNK = 20 * FIFO_FRAME_LEN  # bytes per FIFO_R_W transaction
+
+# "burst": one 14 byte block read per MPU, "word": 12 single byte reads per MPU,
+# "fifo": the MPU samples at SAMPLE_RATE_HZ and we drain its on-chip FIFO
+READ_MODE = "burst"
+SAMPLE_RATE_HZ = 500  # only used in "fifo" mode, 1 kHz / (1 + SMPLRT_DIV), the nearest such rate is used
+DLPF_CFG = 1  # 184 Hz bandwidth, keeps the gyro output rate at 1 kHz
+GYRO_OUTPUT_RATE_HZ = 1000  # with the DLPF on
+FIFO_POLL_INTERVAL = 0.01  # seconds between FIFO drains
+
+# Samples per UDP datagram and the longest a sample may wait for its batch
+BATCH_MAX_SAMPLES = 32
+BATCH_MAX_LATENCY = 0.005  # seconds
+
+# Where the orientation (Madgwick) is computed:
+# "laptop": the Pi only sends raw samples, UDPLaptop.py runs the filters
+# "worker": a separate process on the Pi runs one filter per MPU and sends quaternions
+FUSION = "laptop"
+
+# One reader thread per I2C bus, so both buses are read at the same time.
+# False reads all MPUs one after another in the main loop
+THREADED = True
+
+# One status line every STATUS_INTERVAL seconds, VERBOSE also prints every sample
+STATUS_INTERVAL = 1.0
+VERBOSE = False
+status = IMUStatus.StatusLine(STATUS_INTERVAL)
 
 # Setup: Initialize each MPU on each bus
 i2c_buses = [0, 1]  # /dev/i2c-0 and /dev/i2c-1
@@ -44,12 +89,91 @@ def read_word(bus, addr, reg):
         val -= 0x10000
     return val
 
-def get_program_time():
+def read_burst(bus, addr):
+    """
+    Reads accelerometer, temperature and gyroscope registers in one
+    I2C block transaction and returns the six signed axes
+    (ax, ay, az, gx, gy, gz)
+    """
+    block = bus.read_i2c_block_data(addr, ACCEL_XOUT_H, BURST_LEN)
+    ax, ay, az, temp, gx, gy, gz = struct.unpack('>7h', bytes(block))
+    return ax, ay, az, gx, gy, gz
+
+def read_axes(bus, addr):
+    """
+    Reads the six IMU axes using the configured READ_MODE
+    """
+    if READ_MODE == "burst":
+        return read_burst(bus, addr)
+    ax = read_word(bus, addr, ACCEL_XOUT_H)
+    ay = read_word(bus, addr, ACCEL_XOUT_H + 2)
+    az = read_word(bus, addr, ACCEL_XOUT_H + 4)
+    gx = read_word(bus, addr, GYRO_XOUT_H)
+    gy = read_word(bus, addr, GYRO_XOUT_H + 2)
+    gz = read_word(bus, addr, GYRO_XOUT_H + 4)
+    return ax, ay, az, gx, gy, gz
+
+def sample_rate_divider(rate_hz):
+    """
+    SMPLRT_DIV value for the rate closest to rate_hz, the MPU then
+    samples at GYRO_OUTPUT_RATE_HZ / (1 + divider)
+    """
+    divider = round(GYRO_OUTPUT_RATE_HZ / rate_hz) - 1
+    if not 0 <= divider <= 255:
+        raise ValueError(f"SAMPLE_RATE_HZ {rate_hz} is outside "
+                         f"{GYRO_OUTPUT_RATE_HZ / 256:.2f}..{GYRO_OUTPUT_RATE_HZ} Hz")
+    return divider
+
+def setup_fifo(bus, addr):
+    """
+    Configures the sample rate divider and DLPF and lets the MPU
+    push accelerometer and gyroscope frames into its FIFO
+    """
+    bus.write_byte_data(addr, CONFIG, DLPF_CFG)
+    bus.write_byte_data(addr, SMPLRT_DIV, FIFO_DIVIDER)
+    reset_fifo(bus, addr)
+    bus.write_byte_data(addr, FIFO_EN, FIFO_EN_ACCEL_GYRO)
+
+def reset_fifo(bus, addr):
+    """
+    Empties the FIFO and (re)enables it
+    """
+    bus.write_byte_data(addr, USER_CTRL, USER_CTRL_FIFO_RESET)
+    bus.write_byte_data(addr, USER_CTRL, USER_CTRL_FIFO_EN)
+    bus.read_byte_data(addr, INT_STATUS)  # clears a pending overflow flag
+
+def read_fifo(bus, addr):
+    """
+    Drains all complete frames from the FIFO in bulk reads.
+    Returns a list of (ax, ay, az, gx, gy, gz) tuples and whether
+    the FIFO overflowed (in which case it is reset and the list is empty)
+    """
+    if bus.read_byte_data(addr, INT_STATUS) & INT_FIFO_OFLOW:
+        reset_fifo(bus, addr)
+        return [], True
+
+    high, low = bus.read_i2c_block_data(addr, FIFO_COUNTH, 2)
+    count = (high << 8) + low
+    count -= count % FIFO_FRAME_LEN
+
+    data = bytearray()
+    while len(data) < count:
+        length = min(FIFO_READ_CHUNK, count - len(data))
+        write = i2c_msg.write(addr, [FIFO_R_W])
+        read = i2c_msg.read(addr, length)
+        bus.i2c_rdwr(write, read)
+        data += bytes(read)
+
+    frames = [struct.unpack_from('>6h', data, offset)
+              for offset in range(0, count, FIFO_FRAME_LEN)]
+    return frames, False
+
+def get_timestamp_ns():
     """
-     Computes the time elapsed since the program started
+    Sample time on the Pi's monotonic clock in ns, the laptop converts
+    it to its own session time line (see IMUClock.py)
     """
-    programtime = starttime - time.time() # moet dit nit anders om!
-    return programtime
+    return time.monotonic_ns()
 
 def send_over_socket(programtime, imu):
     # defined but not used
@@ -60,79 +184,226 @@ def send_over_socket(programtime, imu):
     row = f"{programtime}"
     for key, value in imu.items():
         row += f", {value}"
-    print(row)
+    if VERBOSE:
+        print(row)
     UDPMessage = sock.sendto(row.encode(), (UDP_IP, UDP_PORT))
 
-def quaternion_to_euler(q):
+def process_sample(bus_num, addr, timestamp_ns, ax, ay, az, gx, gy, gz):
     """
-    Changes quarternion angles to euler angles
+    Numbers one raw sample and queues it for sending
     """
-    q0, q1, q2, q3 = q
-    roll = np.arctan2(2 * (q0*q1 + q2*q3), 1 - 2 * (q1**2 + q2**2)) * 57.3
-    pitch = np.arcsin(2 * (q0*q2 - q3*q1)) * 57.3
-    yaw = np.arctan2(2 * (q0*q3 + q1*q2), 1 - 2 * (q2**2 + q3**2)) * 57.3
-    return roll, pitch, yaw
+    seq = sequence[(bus_num, addr)]
+    sequence[(bus_num, addr)] = (seq + 1) % IMUProtocol.SEQ_MODULO
+    sample = IMUProtocol.Sample(addr, bus_num, seq, timestamp_ns,
+                                ax, ay, az, gx, gy, gz, None)
 
-def dict_writer(addr, bus_num, programtime, q):
+    # Queue for the next datagram
+    sender.add(sample)
+    status.count(f"0x{addr:02X}/{bus_num}")
+    if VERBOSE:
+        print(sample)
+
+class QueueSocket:
     """
-    creates a dictionary to be send to socket
+    Stands in for the UDP socket of a BatchSender and hands the raw
+    packets to the fusion worker instead
     """
-    roll, pitch, yaw = quaternion_to_euler(q)
 
-    data_dict = {
-        'addr': addr,
-        'bus_num': bus_num,
-        'programtime': programtime,
-        'roll': roll,
-        'pitch': pitch,
-        'yaw': yaw,
-        'Accel': [ax, ay, az],
-        'Gyro': [gx, gy, gz]
-    } 
-    return data_dict
+    def __init__(self, packet_queue):
+        self.packet_queue = packet_queue
+
+    def sendto(self, packet, address):
+        self.packet_queue.put(packet)
+
+def fusion_worker(packet_queue, address):
+    """
+    Runs one Madgwick filter per MPU on the raw packets from the
+    acquisition loop and sends the samples on with their quaternion
+    """
+    # sock is inherited from the parent, so the data keeps the source
+    # port the clock sync responder listens on
+    fused_sender = IMUProtocol.BatchSender(sock, address, IMUProtocol.FLAG_QUATERNION,
+                                           BATCH_MAX_SAMPLES, BATCH_MAX_LATENCY)
+    filters = {}
+    quaternions = {}
+    last_time = {}
+    try:
+        while True:
+            packet = packet_queue.get()
+            if packet is None:
+                break
+            for sample in IMUProtocol.decode_packet(packet):
+                key = (sample.bus_num, sample.addr)
+                if key not in filters:
+                    filters[key] = Madgwick()
+                    quaternions[key] = np.array([1.0, 0.0, 0.0, 0.0])
+                gyr = np.radians(np.array([sample.gx, sample.gy, sample.gz]) / IMUProtocol.GYRO_LSB_PER_DPS)
+                acc = np.array([sample.ax, sample.ay, sample.az], dtype=float)
+                dt = None
+                if key in last_time and sample.timestamp_ns != last_time[key]:
+                    dt = abs(sample.timestamp_ns - last_time[key]) / 1e9
+                last_time[key] = sample.timestamp_ns
+                quaternions[key] = filters[key].updateIMU(quaternions[key], gyr=gyr, acc=acc, dt=dt)
+                fused_sender.add(sample._replace(q=tuple(quaternions[key])))
+            fused_sender.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        fused_sender.flush()
 
 buses = {bus_num: SMBus(bus_num) for bus_num, _ in mpus}
 
+fusion_process = None
+if FUSION == "worker":
+    # Start before the reader threads, fork and threads do not mix. Fork
+    # explicitly: the worker uses the inherited sock, and under spawn or
+    # forkserver the child would import this script and run it again
+    fork = multiprocessing.get_context("fork")
+    packet_queue = fork.Queue()
+    fusion_process = fork.Process(target=fusion_worker,
+                                  args=(packet_queue, (UDP_IP, UDP_PORT)), daemon=True)
+    fusion_process.start()
+    sender = IMUProtocol.BatchSender(QueueSocket(packet_queue), None, 0,
+                                     BATCH_MAX_SAMPLES, BATCH_MAX_LATENCY)
+else:
+    sender = IMUProtocol.BatchSender(sock, (UDP_IP, UDP_PORT), 0,
+                                     BATCH_MAX_SAMPLES, BATCH_MAX_LATENCY)
+
+# Per MPU sequence number, lets the laptop see lost and reordered packets
+sequence = {mpu: 0 for mpu in mpus}
+
+# In fifo mode every MPU gets a sample index that counts FIFO frames,
+# so the sample time follows from the sensor clock instead of from Python.
+# The period is that of the rate the divider really gives, in whole ns
+fifo_index = {mpu: 0 for mpu in mpus}
+fifo_start = {}
+fifo_overflows = {mpu: 0 for mpu in mpus}
+if READ_MODE == "fifo":
+    FIFO_DIVIDER = sample_rate_divider(SAMPLE_RATE_HZ)
+    FIFO_PERIOD_NS = (1 + FIFO_DIVIDER) * 1_000_000_000 // GYRO_OUTPUT_RATE_HZ
+    for bus_num, addr in mpus:
+        setup_fifo(buses[bus_num], addr)
+        fifo_start[(bus_num, addr)] = get_timestamp_ns()
+
+def acquire(bus_num, addr):
+    """
+    Reads the new sample(s) of one MPU using the configured READ_MODE.
+    Returns a list of (timestamp_ns, (ax, ay, az, gx, gy, gz))
+    """
+    bus = buses[bus_num]  # reuse opened bus
+    if READ_MODE != "fifo":
+        axes = read_axes(bus, addr)
+        return [(get_timestamp_ns(), axes)]
+
+    frames, overflow = read_fifo(bus, addr)
+    if overflow:
+        # Frames were lost, jump the index to the wall clock so
+        # the gap shows up in the time base
+        lost_until = (get_timestamp_ns() - fifo_start[(bus_num, addr)]) // FIFO_PERIOD_NS
+        fifo_index[(bus_num, addr)] = max(fifo_index[(bus_num, addr)], lost_until)
+        fifo_overflows[(bus_num, addr)] += 1
+        status.close()
+        print(f"FIFO overflow on MPU 0x{addr:02X} bus {bus_num}")
+    samples = []
+    for frame in frames:
+        timestamp_ns = fifo_start[(bus_num, addr)] + fifo_index[(bus_num, addr)] * FIFO_PERIOD_NS
+        fifo_index[(bus_num, addr)] += 1
+        samples.append((timestamp_ns, frame))
+    return samples
+
+# SimpleQueue is implemented in C and does not take a Python level lock,
+# the bus readers only put and the sender only gets
+sample_queue = queue.SimpleQueue()
+stop_event = threading.Event()
+
+def bus_reader(bus_num, addrs):
+    """
+    Reads all MPUs on one bus until stop_event is set and puts
+    (bus_num, addr, timestamp_ns, axes) on sample_queue
+    """
+    try:
+        while not stop_event.is_set():
+            for addr in addrs:
+                for timestamp_ns, axes in acquire(bus_num, addr):
+                    sample_queue.put((bus_num, addr, timestamp_ns, axes))
+            if READ_MODE == "fifo":
+                time.sleep(FIFO_POLL_INTERVAL)
+    except Exception as e:
+        print(f"Reader for bus {bus_num} stopped: {e}")
+
+def sync_responder():
+    """
+    Echoes the laptop's clock pings with our receive and send time,
+    runs for the lifetime of the program
+    """
+    while True:
+        try:
+            data, address = sock.recvfrom(64)
+            t2 = get_timestamp_ns()
+            t1, _, _ = IMUProtocol.decode_sync(data)
+        except (IMUProtocol.ProtocolError, ConnectionRefusedError):
+            continue
+        except OSError:
+            break
+        sock.sendto(IMUProtocol.encode_sync(t1, t2, get_timestamp_ns()), address)
+
+threading.Thread(target=sync_responder, daemon=True).start()
+
+readers = []
+if THREADED:
+    for bus_num in buses:
+        addrs = [addr for mpu_bus, addr in mpus if mpu_bus == bus_num]
+        reader = threading.Thread(target=bus_reader, args=(bus_num, addrs), daemon=True)
+        reader.start()
+        readers.append(reader)
+
 # Loops through each MPU device, reads: Accelerometer and Gyroscope
-# Sends the data via UDP as csv formatted string
+# Sends the data via UDP as binary IMUProtocol packets
+def report_status():
+    """
+    Prints the status line with the current queue depth and FIFO overflows
+    """
+    if THREADED:
+        status.set('queue', sample_queue.qsize())
+    if READ_MODE == "fifo":
+        status.set('overflows', sum(fifo_overflows.values()))
+    status.report()
+
 try:
     while True:
+        if status.due():
+            report_status()
+        if THREADED:
+            timeout = sender.time_until_flush()
+            try:
+                bus_num, addr, timestamp_ns, axes = sample_queue.get(timeout=0.5 if timeout is None else max(timeout, 0))
+            except queue.Empty:
+                sender.poll()
+                if not any(reader.is_alive() for reader in readers):
+                    break
+                continue
+            process_sample(bus_num, addr, timestamp_ns, *axes)
+            continue
+
         for bus_num, addr in mpus:
-            bus = buses[bus_num]  # reuse opened bus
-            ax = read_word(bus, addr, ACCEL_XOUT_H)
-            ay = read_word(bus, addr, ACCEL_XOUT_H + 2)
-            az = read_word(bus, addr, ACCEL_XOUT_H + 4)
-            gx = read_word(bus, addr, GYRO_XOUT_H)
-            gy = read_word(bus, addr, GYRO_XOUT_H + 2)
-            gz = read_word(bus, addr, GYRO_XOUT_H + 4)
-            programtime = get_program_time()
-
-            ### ! ###
-            ### Is normalizatie wel nodig? Wij willen toch de juiste accelratie data ####
-            ### wordt atm ook niet gebruikt ###
-
-            # Normalize accelerometer data
-            accel = np.array([ax, ay, az])  # adjust scale as needed
-            # accel_norm = np.linalg.norm(accel)
-            gyro = np.radians(np.array([gx, gy, gz]))  # convert to rad/s
-            # gyro_norm = np.linalg.norm(gyro)
-
-            # Update AHRS filter
-            accel_norm = accel / np.linalg.norm(accel)
-            q = madgwick_filter.updateIMU(gyro, accel)
-
-            if q is not None:
-                data_dict = dict_writer(addr, bus_num, programtime, q)
-
-                # Format and send
-                datasend = str(data_dict)
-                UDPMessage = sock.sendto(datasend.encode(), (UDP_IP, UDP_PORT))
-            else: 
-                print('q is none')
+            for timestamp_ns, axes in acquire(bus_num, addr):
+                process_sample(bus_num, addr, timestamp_ns, *axes)
+        sender.poll()
+        if READ_MODE == "fifo":
+            sender.flush()
+            time.sleep(FIFO_POLL_INTERVAL)
 
 except KeyboardInterrupt:
+    status.close()
     print("Stopping...")
 finally:
+    sender.flush()
+    stop_event.set()
+    for reader in readers:
+        reader.join(timeout=1)
+    if fusion_process is not None:
+        packet_queue.put(None)
+        fusion_process.join(timeout=2)
 # Always close the buses when done
     for bus in buses.values():
         bus.close()
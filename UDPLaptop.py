@@ -1,129 +1,393 @@
 import socket
 import csv
 import os
+import threading
+import queue
+import asyncio
+import time
 from datetime import datetime
 from ahrs.filters import Madgwick
 import numpy as np
+import IMUProtocol
+import IMUWriter
+import IMUStatus
+import IMUClock
+import IMUCapture
+import vibestore
+
+UDP_IP = "0.0.0.0"
+UDP_PORT = 5005
+RCVBUF_BYTES = 4 * 1024 * 1024  # kernel receive buffer, capped by net.core.rmem_max
+PACKET_QUEUE_SIZE = 10000  # datagrams waiting between the receive thread and the parser
+
+# "thread": one rig, everything goes to csv/<starttime>/
+# "asyncio": any number of rigs, every sending Pi gets csv/<starttime>/<ip>/
+RECEIVER = "thread"
+
+# One status line every STATUS_INTERVAL seconds, VERBOSE also prints every sample
+STATUS_INTERVAL = 1.0
+VERBOSE = False
+
+# One open, buffered CSV file per IMU (and per gap log), flushed every
+# CSV_FLUSH_ROWS rows or CSV_FLUSH_SECONDS seconds and on shutdown
+CSV_FLUSH_ROWS = 500
+CSV_FLUSH_SECONDS = 1.0
+# Binary capture file per IMU (IMUCapture.py), constant memory for long recordings
+WRITE_CSV = True
+WRITE_CAPTURE = True
+# Also store the session as session.npz (vibestore.py) on close, built from
+# the capture files if there are any. Off by default, the captures already
+# hold the same samples and vibestore.py can convert afterwards
+SESSION_NPZ = False
+CSV_FIELDNAMES = ['programtime', 'ax', 'ay', 'az', 'gx', 'gy', 'gz', 'q0', 'q1', 'q2', 'q3', 'sendertime']
+GAP_FIELDNAMES = ['programtime', 'first_missing_seq', 'missing']
+
+# Clock pings to every sender, quicker at the start to lock on fast
+SYNC_INTERVAL = 1.0  # seconds
+SYNC_STARTUP_PINGS = 10
+SYNC_STARTUP_INTERVAL = 0.1  # seconds
 
 # Create output directory based on program start time
 starttime = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
 csv_folder = os.path.join("csv", starttime)
-os.makedirs(csv_folder, exist_ok=True)
-
-imu_data = {
-    (104, 0): [],
-    (104, 1): [],
-    (105, 0): [],
-    (105, 1): []
-}
-imu_filters = {
-    (104, 0): Madgwick(),
-    (104, 1): Madgwick(),
-    (105, 0): Madgwick(),
-    (105, 1): Madgwick()
-}
-# Store last quaternion per IMU
-imu_quaternions = {
-    (104, 0): np.array([1.0, 0.0, 0.0, 0.0]),
-    (104, 1): np.array([1.0, 0.0, 0.0, 0.0]),
-    (105, 0): np.array([1.0, 0.0, 0.0, 0.0]),
-    (105, 1): np.array([1.0, 0.0, 0.0, 0.0])
-}
+
+status = IMUStatus.StatusLine(STATUS_INTERVAL)
 
 
 def get_csv_filename(addr, bus_num):
-    return os.path.join(csv_folder, f"imu_{addr}_{bus_num}.csv")
+    return f"imu_{addr}_{bus_num}.csv"
 
-def write_to_csv(addr, bus_num, data_row):
-    filename = get_csv_filename(addr, bus_num)
-    file_exists = os.path.isfile(filename)
 
-    fieldnames = ['programtime', 'ax', 'ay', 'az', 'gx', 'gy', 'gz', 'q0', 'q1', 'q2', 'q3']
-    with open(filename, mode='a', newline='') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+class IMUStream:
+    """
+    State of one IMU of one sender: orientation filter, last quaternion,
+    sample time of the previous sample and the sequence tracker
+    """
 
-        if not file_exists:
-            writer.writeheader()
+    def __init__(self, addr, bus_num, label=None):
+        self.addr = addr
+        self.bus_num = bus_num
+        self.label = label or f"imu {addr}_{bus_num}"
+        self.filter = Madgwick()
+        self.quaternion = np.array([1.0, 0.0, 0.0, 0.0])
+        self.last_time = None
+        self.sequence = IMUProtocol.SequenceTracker()
 
-        writer.writerow(data_row)
-
-def process_udp_data(datasend):
-    try:
-        parts = datasend.strip().split(',')
-        if len(parts) != 9:
-            print("Invalid data format")
+    def process(self, sample, writers, programtime, captures=None):
+        """
+        Fuses one sample and writes it to the CSV and/or the capture file
+        (and a gap marker if needed), programtime is the sample time on the
+        session time line in seconds
+        """
+        arrival = self.sequence.update(sample.seq, sample.timestamp_ns)
+        if arrival == self.sequence.DUPLICATE:
             return
+        # The clock is slewed, not stepped, so programtime only goes back for
+        # a late (reordered) sample. It keeps its own time, rows stay in
+        # arrival order and the readers sort by programtime
+        if arrival == self.sequence.GAP:
+            first_missing, missing = self.sequence.gaps[-1]
+            writer = writers.get(f"gaps_{self.addr}_{self.bus_num}.csv", GAP_FIELDNAMES)
+            # programtime is the time of the first sample after the gap
+            writer.writerow({'programtime': programtime,
+                             'first_missing_seq': first_missing,
+                             'missing': missing})
 
-        addr = int(parts[0].strip())
-        bus_num = int(parts[1].strip())
-        programtime = float(parts[2].strip())
-        roll = float(parts[3].strip())
-        pitch = float(parts[4].strip())
-        yaw = float(parts[5].strip())
-        # ax = float(parts[3].strip())
-        # ay = float(parts[4].strip())
-        # az = float(parts[5].strip())
-        # gx = float(parts[6].strip())
-        # gy = float(parts[7].strip())
-        # gz = float(parts[8].strip())
-        ax = float(parts[6].strip())
-        ay = float(parts[7].strip())
-        az = float(parts[8].strip())
-        gx = float(parts[9].strip())
-        gy = float(parts[10].strip())
-        gz = float(parts[11].strip())
-
-
-        key = (addr, bus_num)
-        if key not in imu_data:
-            print(f"Unknown IMU address/bus: {key}")
-            return
+        if sample.q is not None:
+            # Quaternion was already computed on the Pi
+            q_new = np.array(sample.q, dtype=float)
+        else:
+            # Convert gyroscope from LSB to rad/s
+            gyr = np.radians(np.array([sample.gx, sample.gy, sample.gz]) / IMUProtocol.GYRO_LSB_PER_DPS)
+            acc = np.array([sample.ax, sample.ay, sample.az], dtype=float)
 
-        # Convert gyroscope to rad/s
-        gyr = np.radians([gx, gy, gz])
-        acc = np.array([ax, ay, az])
+            # Time step from the Pi's sample times, filter default if unknown
+            dt = None
+            if self.last_time is not None and sample.timestamp_ns != self.last_time:
+                dt = abs(sample.timestamp_ns - self.last_time) / 1e9
 
-        # Use previous quaternion as input
-        q_prev = imu_quaternions[key]
-        filter = imu_filters[key]
+            # Use previous quaternion as input
+            q_new = self.filter.updateIMU(self.quaternion, gyr=gyr, acc=acc, dt=dt)
+        self.last_time = sample.timestamp_ns
+        self.quaternion = q_new  # update stored quaternion
 
-        q_new = filter.updateIMU(q_prev, gyr=gyr, acc=acc)
-        imu_quaternions[key] = q_new  # update stored quaternion
+        if captures is not None:
+            captures.get(self.addr, self.bus_num).append(
+                programtime, sample.timestamp_ns, sample.seq,
+                sample.ax, sample.ay, sample.az, sample.gx, sample.gy, sample.gz, *q_new)
+        status.count(self.label)
+        if not WRITE_CSV and not VERBOSE:
+            return
 
         data_row = {
             'programtime': programtime,
-            'ax': ax,
-            'ay': ay,
-            'az': az,
-            'gx': gx,
-            'gy': gy,
-            'gz': gz,
+            'ax': sample.ax,
+            'ay': sample.ay,
+            'az': sample.az,
+            'gx': sample.gx,
+            'gy': sample.gy,
+            'gz': sample.gz,
             'q0': q_new[0],
             'q1': q_new[1],
             'q2': q_new[2],
-            'q3': q_new[3]
+            'q3': q_new[3],
+            'sendertime': sample.timestamp_ns / 1e9
         }
 
-        imu_data[key].append(data_row)
-        write_to_csv(addr, bus_num, data_row)
-        print(f"Data written for IMU {key} with quaternion")
+        if WRITE_CSV:
+            writers.get(get_csv_filename(self.addr, self.bus_num), CSV_FIELDNAMES).writerow(data_row)
+        if VERBOSE:
+            print(f"Data written for IMU {(self.addr, self.bus_num)} with quaternion: {data_row}")
 
-    except ValueError as e:
-        print(f"Error parsing data: {e}")
 
-UDP_IP = "0.0.0.0"
-UDP_PORT = 5005
+class DeviceSession:
+    """
+    Everything received from one sender (or from all senders in "thread"
+    mode): its IMU streams and CSV writers, created when first needed
+    """
+
+    def __init__(self, folder, name=""):
+        self.folder = folder
+        self.name = name
+        self.writers = IMUWriter.CSVWriterPool(folder, CSV_FLUSH_ROWS, CSV_FLUSH_SECONDS)
+        self.captures = IMUCapture.CapturePool(folder, CSV_FLUSH_SECONDS) if WRITE_CAPTURE else None
+        self.streams = {}
+        # Session time line: laptop monotonic clock, 0 at the session start
+        self.start_ns = time.monotonic_ns()
+        self.clock = IMUClock.ClockSync()
+        self.address = None
+        self.pings_sent = 0
+        self.last_ping = None
 
-sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-sock.bind((UDP_IP, UDP_PORT))
+    def process_udp_data(self, datasend, address=None, received_ns=None):
+        """
+        Handles one datagram, address and received_ns (laptop
+        time.monotonic_ns() on arrival) are needed for clock sync
+        """
+        if received_ns is None:
+            received_ns = time.monotonic_ns()
+        if address is not None:
+            self.address = address
+        try:
+            if IMUProtocol.packet_flags(datasend) & IMUProtocol.FLAG_SYNC:
+                t1, t2, t3 = IMUProtocol.decode_sync(datasend)
+                self.clock.add(t1, t2, t3, received_ns)
+                return
+            samples = IMUProtocol.decode_packet(datasend)
+        except IMUProtocol.ProtocolError as e:
+            print(f"Error parsing data: {e}")
+            return
 
-print(f"Listening for UDP messages on port {UDP_PORT}...")
+        for sample in samples:
+            if not self.clock.synced:
+                self.clock.observe(sample.timestamp_ns, received_ns)
+            key = (sample.addr, sample.bus_num)
+            stream = self.streams.get(key)
+            if stream is None:
+                label = f"{self.name} imu {key[0]}_{key[1]}".strip()
+                stream = self.streams[key] = IMUStream(*key, label=label)
+            programtime = (self.clock.to_session(sample.timestamp_ns) - self.start_ns) / 1e9
+            stream.process(sample, self.writers, programtime, self.captures)
+
+    def poll(self, sendto=None):
+        """
+        Flushes old CSV buffers and, given a sendto(data, address)
+        function, pings the sender when the next clock sync is due
+        """
+        self.writers.poll()
+        if self.captures is not None:
+            self.captures.poll()
+        if sendto is None or self.address is None:
+            return
+        now = time.monotonic()
+        interval = SYNC_STARTUP_INTERVAL if self.pings_sent < SYNC_STARTUP_PINGS else SYNC_INTERVAL
+        if self.last_ping is None or now - self.last_ping >= interval:
+            self.last_ping = now
+            self.pings_sent += 1
+            sendto(IMUProtocol.encode_sync(time.monotonic_ns()), self.address)
+
+    def lost(self):
+        return sum(stream.sequence.lost for stream in self.streams.values())
+
+    def close(self):
+        self.writers.close()
+        if self.captures is not None:
+            self.captures.close()
+        self.write_stream_stats()
+        if SESSION_NPZ and self.streams:
+            # A failed conversion must not keep other sessions from closing
+            try:
+                if self.captures is not None:
+                    vibestore.convert_captures(self.folder)
+                else:
+                    vibestore.convert_session(self.folder, force=True)
+            except Exception as e:
+                print(f"Error writing {vibestore.SESSION_FILE} for {self.folder}: {e}")
+
+    def write_stream_stats(self):
+        """
+        Writes the loss/duplicate/reorder counters of this session to stream_stats.csv
+        """
+        rows = []
+        for (addr, bus_num), stream in self.streams.items():
+            if stream.sequence.received == 0:
+                continue
+            rows.append({'addr': addr, 'bus_num': bus_num, **stream.sequence.stats()})
+            print(f"IMU {(addr, bus_num)}: {stream.sequence.stats()}")
+        if not rows:
+            return
+        with open(os.path.join(self.folder, "stream_stats.csv"), mode='w', newline='') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+def open_socket(timeout=None):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RCVBUF_BYTES)
+    sock.bind((UDP_IP, UDP_PORT))
+    sock.settimeout(timeout)
+    print(f"Listening for UDP messages on port {UDP_PORT} "
+          f"(receive buffer {sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)} bytes)...")
+    return sock
+
+
+def run_threaded():
+    """
+    One rig: the receive thread only copies datagrams into packet_queue,
+    parsing, filtering and writing happen in the main loop so a slow
+    disk never keeps the socket from being emptied
+    """
+    sock = open_socket(timeout=0.5)  # lets the receive thread notice stop_event
+    session = DeviceSession(csv_folder)
+    packet_queue = queue.Queue(maxsize=PACKET_QUEUE_SIZE)
+    receiver_stats = {'received': 0, 'dropped': 0}
+    stop_event = threading.Event()
+
+    def receive_loop():
+        """
+        Receives datagrams into one preallocated buffer and hands copies to
+        packet_queue, counting the ones that do not fit in the queue
+        """
+        buffer = bytearray(65535)
+        view = memoryview(buffer)
+        while not stop_event.is_set():
+            try:
+                nbytes, sender = sock.recvfrom_into(buffer)
+            except socket.timeout:
+                continue
+            received_ns = time.monotonic_ns()
+            receiver_stats['received'] += 1
+            try:
+                packet_queue.put_nowait((bytes(view[:nbytes]), sender, received_ns))
+            except queue.Full:
+                receiver_stats['dropped'] += 1
+
+    receiver = threading.Thread(target=receive_loop, daemon=True)
+    receiver.start()
 
-while True:
     try:
-        data, addr = sock.recvfrom(1024)
-        print(f"{data.decode()}")
-        process_udp_data(data.decode())
+        while True:
+            try:
+                session.process_udp_data(*packet_queue.get(timeout=0.1))
+            except queue.Empty:
+                pass
+            session.poll(sock.sendto)
+            if status.due():
+                status.set('queue', packet_queue.qsize())
+                status.set('dropped', receiver_stats['dropped'])
+                status.set('lost', session.lost())
+                status.set('write lag s', session.writers.lag())
+                if session.clock.synced:
+                    status.set('sync delay ms', session.clock.delay / 1e6)
+                status.report()
     except KeyboardInterrupt:
+        status.close()
         print("Stopping")
-        break
\ No newline at end of file
+    finally:
+        stop_event.set()
+        receiver.join(timeout=1)
+        # Whatever was already received still gets written
+        while not packet_queue.empty():
+            session.process_udp_data(*packet_queue.get_nowait())
+        session.close()
+        sock.close()
+        print(f"Datagrams received: {receiver_stats['received']}, "
+              f"dropped (queue full): {receiver_stats['dropped']}")
+
+
+class IMUDatagramProtocol(asyncio.DatagramProtocol):
+    """
+    Receives from any number of Pis, every source address gets its own
+    DeviceSession in csv/<starttime>/<ip>/ on its first datagram
+    """
+
+    def __init__(self):
+        self.sessions = {}
+        self.received = 0
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        received_ns = time.monotonic_ns()
+        self.received += 1
+        host = addr[0]
+        session = self.sessions.get(host)
+        if session is None:
+            status.close()
+            print(f"New sender {host}")
+            session = self.sessions[host] = DeviceSession(os.path.join(csv_folder, host), host)
+        session.process_udp_data(data, addr, received_ns)
+
+    def error_received(self, exc):
+        print(f"Socket error: {exc}")
+
+    def poll(self):
+        for session in self.sessions.values():
+            session.poll(self.transport.sendto)
+        status.set('senders', len(self.sessions))
+        status.set('lost', sum(session.lost() for session in self.sessions.values()))
+        status.set('write lag s', max((session.writers.lag() for session in self.sessions.values()), default=0.0))
+        status.poll()
+
+    def close(self):
+        status.close()
+        for host, session in self.sessions.items():
+            print(f"Closing session of {host}")
+            session.close()
+
+
+async def serve(stop_event=None):
+    """
+    Runs the multi-rig receiver until stop_event is set (or the task is
+    cancelled, which is what Ctrl+C does under asyncio.run)
+    """
+    loop = asyncio.get_running_loop()
+    sock = open_socket()
+    sock.setblocking(False)
+    transport, protocol = await loop.create_datagram_endpoint(IMUDatagramProtocol, sock=sock)
+    if stop_event is None:
+        stop_event = asyncio.Event()
+    try:
+        while not stop_event.is_set():
+            try:
+                await asyncio.wait_for(stop_event.wait(), timeout=SYNC_STARTUP_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            protocol.poll()
+    finally:
+        transport.close()
+        protocol.close()
+        print(f"Datagrams received: {protocol.received}")
+
+
+if __name__ == "__main__":
+    if RECEIVER == "asyncio":
+        try:
+            asyncio.run(serve())
+        except KeyboardInterrupt:
+            print("Stopping")
+    else:
+        run_threaded()
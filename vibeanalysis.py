@@ -0,0 +1,442 @@
+"""Step analysis shared by vibeextract.py, vibeextract2.py and vibevisualise.py
+
+analyse_step() takes one recording of one IMU as arrays and finds the step:
+
+    1. raw LSB to m/s² and °/s, zero phase Butterworth low pass
+    2. the latest of the largest acceleration peaks, the baseline_window_size
+       samples before it are the baseline (standing still)
+    3. rotation turning the baseline gravity vector to +z (Rodrigues),
+       applied to acceleration and angular velocity ("upright")
+    4. step start and end, where the upright acceleration leaves and returns
+       to within deviation_threshold of the baseline
+    5. largest acceleration deviation and angular velocity per axis in the step
+
+Everything is plain NumPy on (N, 6) arrays with the columns ax ay az gx gy gz,
+scaled in place, filtered in one call (vibefilter.py) and rotated with one matrix product,
+only the metrics go back into pandas.
+
+analyse_session() does the same for all IMUs of one session together: the
+sensors go on one time grid (viberesample.py), every sensor finds its step,
+and the metrics of all sensors are taken over one shared step window, with
+the timing of each sensor's own step relative to a reference sensor.
+"""
+from dataclasses import dataclass, field, replace
+
+import numpy as np
+import pandas as pd
+from scipy.signal import find_peaks
+
+import vibefilter
+import viberesample
+
+G_TO_MS2 = 9.80665
+RAW_COLUMNS = ['ax', 'ay', 'az', 'gx', 'gy', 'gz']
+ACC_AXES = ['ax_upright', 'ay_upright', 'az_upright']
+GYRO_AXES = ['gx_upright', 'gy_upright', 'gz_upright']
+
+
+@dataclass(frozen=True)
+class StepParameters:
+    acc_sensitivity_lsb_per_g: float = 16384
+    gyro_sensitivity_lsb_per_dps: float = 131
+    cutoff_freq: float = 3  # Hz
+    filter_order: int = 2
+    baseline_window_size: int = 200  # samples before the last peak
+    deviation_threshold: float = 0.4  # m/s² from the baseline counts as movement
+    stable_duration: float = 1.0  # s within the threshold before the step starts
+    top_peaks: int = 4  # the last of this many largest peaks marks the step
+    upright_peak_distance: int = 20  # samples
+
+
+@dataclass
+class AccPeak:
+    index: int
+    value: float  # m/s²
+    baseline: float
+    deviation: float
+    time: float  # s
+    time_from_baseline: float
+
+
+@dataclass
+class GyroPeak:
+    index: int
+    value: float  # °/s
+    time: float
+    time_from_step_start: float
+
+
+@dataclass
+class StepAnalysis:
+    programtime: np.ndarray  # (N,) s, starting at 0
+    fs: float  # Hz
+    filtered: np.ndarray  # (N, 6) m/s² and °/s
+    rotation_matrix: np.ndarray  # (3, 3) sensor to upright
+    upright: np.ndarray  # (N, 6) filtered, rotated
+    baseline_start_idx: int
+    baseline_end_idx: int
+    baseline_time: float
+    baseline_means: np.ndarray  # (3,) upright acceleration
+    start_idx: int
+    end_idx: int
+    start_time: float
+    end_time: float
+    acc_peaks: dict = field(default_factory=dict)  # ACC_AXES name -> AccPeak or None
+    gyro_peaks: dict = field(default_factory=dict)  # GYRO_AXES name -> GyroPeak
+    max_gyro_magnitude: float = np.nan  # °/s
+    max_gyro_time: float = np.nan
+
+    @property
+    def acc(self):
+        return self.filtered[:, :3]
+
+    @property
+    def gyro(self):
+        return self.filtered[:, 3:]
+
+    @property
+    def acc_upright(self):
+        return self.upright[:, :3]
+
+    @property
+    def gyro_upright(self):
+        return self.upright[:, 3:]
+
+    @property
+    def duration(self):
+        return self.end_time - self.start_time
+
+    @property
+    def step_mask(self):
+        """Samples from start_time up to and including end_time"""
+        return (self.programtime >= self.start_time) & (self.programtime <= self.end_time)
+
+    def metrics(self, min_acc=True):
+        """The columns of the metrics summary, min_acc_* only if asked for"""
+        step_acc = self.acc_upright[self.step_mask]
+        metrics_data = {"step_duration_s": self.duration}
+        for k, axis in enumerate(ACC_AXES):
+            metrics_data[f"avg_acc_{axis}"] = _column_mean(step_acc, k)
+        for k, axis in enumerate(ACC_AXES):
+            peak = self.acc_peaks.get(axis)
+            metrics_data[f"max_acc_{axis}"] = peak.value if peak else np.nan
+            metrics_data[f"time_to_max_acc_{axis}"] = peak.time_from_baseline if peak else np.nan
+            if min_acc:
+                metrics_data[f"min_acc_{axis}"] = step_acc[:, k].min() if len(step_acc) else np.nan
+        for axis in GYRO_AXES:
+            gyro = self.gyro_peaks.get(axis)
+            metrics_data[f"max_ang_vel_{axis}"] = gyro.value if gyro else np.nan
+            metrics_data[f"time_to_max_ang_vel_{axis}"] = gyro.time_from_step_start if gyro else np.nan
+        return metrics_data
+
+
+def read_recording(csv_path):
+    """
+    (programtime, raw) from one sensor CSV, programtime in s starting at 0
+    and counting up (older recordings count down), raw (N, 6) ax..gz in LSB.
+    Rows of late samples, written in arrival order, are sorted into place
+    """
+    df = pd.read_csv(csv_path)
+    programtime = df['programtime'].to_numpy(dtype=float)
+    raw = df[RAW_COLUMNS].to_numpy(dtype=float)
+    if df['programtime'].is_monotonic_decreasing:
+        programtime = programtime[::-1].copy()
+    elif not df['programtime'].is_monotonic_increasing:
+        order = np.argsort(programtime, kind='stable')
+        programtime, raw = programtime[order], raw[order]
+    programtime = programtime - programtime.min()
+    return programtime, raw
+
+
+def rank_peaks(x, peaks, n=None):
+    """
+    Peak indices ordered by |x| at the peak, largest first, equal values in
+    index order (like sorted(..., reverse=True)). Only the top n if given,
+    found with a partition so thousands of candidates stay cheap
+    """
+    peaks = np.asarray(peaks)
+    magnitude = np.abs(x[peaks])
+    if n is not None and len(peaks) > n:
+        # Everything at least as large as the n-th largest, ties included
+        cutoff = np.partition(magnitude, len(peaks) - n)[len(peaks) - n]
+        keep = magnitude >= cutoff
+        peaks, magnitude = peaks[keep], magnitude[keep]
+    order = np.argsort(-magnitude, kind='stable')
+    return peaks[order[:n]]
+
+
+def latest_peak(t, peaks):
+    """The peak with the largest time t, the first one of equal times, None if there are none"""
+    peaks = np.asarray(peaks)
+    if len(peaks) == 0:
+        return None
+    return peaks[np.argmax(t[peaks])]
+
+
+def latest_of_top_peaks(x, t, peaks, n=4):
+    """Of the n peaks largest in |x|, the latest one, None if there are none"""
+    return latest_peak(t, rank_peaks(x, peaks, n))
+
+
+def gravity_rotation(gravity_vector):
+    """Rotation matrix turning gravity_vector onto +z (Rodrigues' formula)"""
+    gravity_vector = gravity_vector / np.linalg.norm(gravity_vector)
+    target_vector = np.array([0, 0, 1])
+    v = np.cross(gravity_vector, target_vector)
+    s = np.linalg.norm(v)
+    c = np.dot(gravity_vector, target_vector)
+    if s == 0:
+        return np.eye(3)
+    vx = np.array([
+        [0, -v[2], v[1]],
+        [v[2], 0, -v[0]],
+        [-v[1], v[0], 0]
+    ])
+    return np.eye(3) + vx + vx @ vx * ((1 - c) / s**2)
+
+
+def find_movement_start(within, outside, baseline_start_idx, last_peak_index, stable_window_size):
+    """
+    Start of the step before last_peak_index: going back from the peak, the
+    first stretch of stable_window_size samples all within the threshold,
+    then the first sample after it (before the peak) that is outside.
+    within/outside are per sample booleans over all axes, a sample exactly
+    at the threshold is neither. baseline_start_idx if there is none
+    """
+    n = len(within)
+    # stable[i]: the stable_window_size samples ending at i are all within
+    within_count = np.concatenate(([0], np.cumsum(within)))
+    ends = np.arange(stable_window_size - 1, n)
+    stable = np.zeros(n, dtype=bool)
+    stable[ends] = within_count[ends + 1] - within_count[ends + 1 - stable_window_size] == stable_window_size
+
+    # next_outside[k]: first outside sample at or after k, n if none
+    next_outside = np.full(n + 1, n)
+    next_outside[:n] = np.minimum.accumulate(np.where(outside, np.arange(n), n)[::-1])[::-1]
+
+    candidates = np.arange(last_peak_index, baseline_start_idx, -1)
+    candidates = candidates[stable[candidates] & (next_outside[candidates + 1] < last_peak_index)]
+    if len(candidates) == 0:
+        return baseline_start_idx
+    return int(next_outside[candidates[0] + 1])
+
+
+def find_movement_end(within, last_peak_index):
+    """First sample from last_peak_index on that is back within the threshold, else the last one"""
+    back = np.flatnonzero(within[last_peak_index:])
+    if len(back) == 0:
+        return len(within) - 1
+    return last_peak_index + int(back[0])
+
+
+def to_units(raw, params=StepParameters()):
+    """Copy of raw (..., 6) ax..gz in LSB as m/s² and °/s, scaled in place"""
+    data = np.array(raw, dtype=float)
+    if data.shape[-1] != 6:
+        raise ValueError(f"Expected ax..gz in the last axis (6 columns), got shape {data.shape}")
+    data[..., :3] /= params.acc_sensitivity_lsb_per_g
+    data[..., :3] *= G_TO_MS2
+    data[..., 3:] /= params.gyro_sensitivity_lsb_per_dps
+    return data
+
+
+def analyse_step(programtime, raw, params=StepParameters()):
+    """
+    Finds the step in one recording, programtime (N,) in s counting up,
+    raw (N, 6) ax..gz in LSB. None if there are no peaks to find it by or
+    the step window is empty
+    """
+    fs = 1 / np.median(np.diff(programtime))
+    filtered = vibefilter.lowpass(to_units(raw, params), fs, params.cutoff_freq, params.filter_order)
+    return analyse_filtered(programtime, filtered, fs, params)
+
+
+def analyse_filtered(programtime, filtered, fs, params=StepParameters()):
+    """analyse_step() after the filter, filtered (N, 6) in m/s² and °/s"""
+    acc = filtered[:, :3]
+
+    last_peak_candidates = []
+    for k in range(3):
+        peaks, _ = find_peaks(acc[:, k], distance=int(fs))
+        last_peak_idx = latest_of_top_peaks(acc[:, k], programtime, peaks, params.top_peaks)
+        if last_peak_idx is not None:
+            last_peak_candidates.append(last_peak_idx)
+    if not last_peak_candidates:
+        return None
+
+    last_peak_index = latest_peak(programtime, last_peak_candidates)
+    baseline_start_idx = max(0, last_peak_index - params.baseline_window_size)
+    baseline_end_idx = last_peak_index
+
+    gravity_vector = np.array([_column_mean(acc[baseline_start_idx:baseline_end_idx], k) for k in range(3)])
+    rotation_matrix = gravity_rotation(gravity_vector)
+    # Both sensors at once: (N, 6) as (2N, 3) rows of x, y, z
+    upright = (filtered.reshape(-1, 3) @ rotation_matrix.T).reshape(filtered.shape)
+    acc_upright = upright[:, :3]
+
+    baseline_window = acc_upright[baseline_start_idx:baseline_end_idx]
+    baseline_time = programtime[baseline_start_idx]
+    baseline_means = np.array([_column_mean(baseline_window, k) for k in range(3)])
+
+    upright_peaks = []
+    for k in range(3):
+        peaks, _ = find_peaks(acc_upright[:, k], distance=params.upright_peak_distance)
+        last_peak_idx = latest_of_top_peaks(acc_upright[:, k], programtime, peaks, params.top_peaks)
+        if last_peak_idx is not None:
+            upright_peaks.append(last_peak_idx)
+    if not upright_peaks:
+        return None
+    last_peak_index = max(upright_peaks)
+
+    deviation = np.abs(acc_upright - baseline_means)
+    within = (deviation < params.deviation_threshold).all(axis=1)
+    outside = (deviation > params.deviation_threshold).any(axis=1)
+    stable_window_size = int(fs * params.stable_duration)
+    start_idx = find_movement_start(within, outside, baseline_start_idx, last_peak_index, stable_window_size)
+    end_idx = find_movement_end(within, last_peak_index)
+    if start_idx > end_idx:
+        # The upright peak lies before the baseline, there is no step after it
+        return None
+
+    step = StepAnalysis(
+        programtime=programtime, fs=fs, filtered=filtered, rotation_matrix=rotation_matrix, upright=upright,
+        baseline_start_idx=baseline_start_idx, baseline_end_idx=baseline_end_idx,
+        baseline_time=baseline_time, baseline_means=baseline_means,
+        start_idx=start_idx, end_idx=end_idx,
+        start_time=programtime[start_idx], end_time=programtime[end_idx])
+    _find_step_peaks(step)
+    return step
+
+
+def with_window(step, start_idx, end_idx):
+    """Copy of step with another step window, the peaks searched again inside it"""
+    step = replace(step, start_idx=start_idx, end_idx=end_idx,
+                   start_time=step.programtime[start_idx], end_time=step.programtime[end_idx],
+                   acc_peaks={}, gyro_peaks={})
+    _find_step_peaks(step)
+    return step
+
+
+def _find_step_peaks(step):
+    """Largest acceleration deviation and angular velocity per axis in the step window"""
+    programtime = step.programtime
+    acc_upright = step.acc_upright
+    gyro_upright = step.gyro_upright
+    step_idx = np.flatnonzero(step.step_mask)
+
+    for k, axis in enumerate(ACC_AXES):
+        baseline = step.baseline_means[k]
+        deviation_series = acc_upright[step_idx, k] - baseline
+        peaks, _ = find_peaks(np.abs(deviation_series), distance=int(step.fs / 2))
+        if len(peaks) == 0:
+            step.acc_peaks[axis] = None
+            continue
+        global_idx = step_idx[peaks[np.argmax(np.abs(deviation_series[peaks]))]]
+        value = acc_upright[global_idx, k]
+        step.acc_peaks[axis] = AccPeak(
+            index=int(global_idx), value=value, baseline=baseline, deviation=value - baseline,
+            time=programtime[global_idx], time_from_baseline=programtime[global_idx] - step.baseline_time)
+
+    step_gyro = gyro_upright[step_idx]
+    for k, axis in enumerate(GYRO_AXES):
+        max_idx = step_idx[np.argmax(np.abs(step_gyro[:, k]))]
+        step.gyro_peaks[axis] = GyroPeak(
+            index=int(max_idx), value=gyro_upright[max_idx, k], time=programtime[max_idx],
+            time_from_step_start=programtime[max_idx] - step.start_time)
+
+    gyro_mag = np.sqrt(step_gyro[:, 0]**2 + step_gyro[:, 1]**2 + step_gyro[:, 2]**2)
+    max_gyro = np.argmax(gyro_mag)
+    step.max_gyro_magnitude = gyro_mag[max_gyro]
+    step.max_gyro_time = programtime[step_idx[max_gyro]]
+
+
+@dataclass
+class SessionAnalysis:
+    time: np.ndarray  # (M,) s, shared grid of all sensors, starting at 0
+    fs: float
+    reference: str  # sensor the lags are measured against
+    steps: dict  # sensor -> StepAnalysis with its own step window
+    window_steps: dict  # sensor -> StepAnalysis over the shared window
+    valid: dict  # sensor -> (M,) bool, False where the sensor had a gap
+    start_idx: int
+    end_idx: int
+
+    @property
+    def start_time(self):
+        return self.time[self.start_idx]
+
+    @property
+    def end_time(self):
+        return self.time[self.end_idx]
+
+    def metrics(self, min_acc=True):
+        """
+        {sensor: metrics over the shared window}, plus the sensor's own step
+        and its timing relative to the reference sensor
+        """
+        reference = self.steps[self.reference]
+        result = {}
+        for name, step in self.steps.items():
+            metrics_data = self.window_steps[name].metrics(min_acc)
+            metrics_data["valid_fraction"] = self.valid[name][self.start_idx:self.end_idx + 1].mean()
+            metrics_data["own_step_duration_s"] = step.duration
+            metrics_data["onset_lag_s"] = step.start_time - reference.start_time
+            metrics_data["end_lag_s"] = step.end_time - reference.end_time
+            metrics_data["max_gyro_lag_s"] = step.max_gyro_time - reference.max_gyro_time
+            result[name] = metrics_data
+        return result
+
+
+def analyse_session(streams, params=StepParameters(), fs=None, max_gap=viberesample.MAX_GAP,
+                    reference=None, window='consensus'):
+    """
+    Finds the step in all sensors of one session together. streams is
+    {sensor: (session time, raw (N, 6))} with times on the shared session
+    clock (viberesample.read_stream). The sensors are put on one grid and
+    filtered in one call, every sensor finds its own step, then the window
+    is the median of their starts and ends ('consensus') or that of the
+    reference sensor ('reference'), default the first one with a step.
+    None if the sensors do not overlap or the reference finds no step
+    """
+    grid, resampled = viberesample.align(streams, fs, max_gap)
+    if len(grid) < 2:
+        return None
+    fs = 1 / np.median(np.diff(grid))
+    time = grid - grid[0]
+    names = list(resampled)
+
+    # (M, sensors, 6) scaled per sensor, then as (M, sensors * 6) every
+    # channel of every sensor in one filter pass
+    data = to_units(np.stack([resampled[name].values for name in names], axis=1), params)
+    filtered = vibefilter.lowpass(data.reshape(len(time), -1), fs, params.cutoff_freq, params.filter_order)
+    del data
+
+    steps = {}
+    for i, name in enumerate(names):
+        step = analyse_filtered(time, np.ascontiguousarray(filtered[:, 6 * i:6 * i + 6]), fs, params)
+        if step is not None:
+            steps[name] = step
+    if reference is None:
+        reference = next(iter(steps), None)
+    if reference not in steps:
+        return None
+
+    if window == 'consensus':
+        start_idx = int(np.median([step.start_idx for step in steps.values()]))
+        end_idx = int(np.median([step.end_idx for step in steps.values()]))
+    elif window == 'reference':
+        start_idx, end_idx = steps[reference].start_idx, steps[reference].end_idx
+    else:
+        raise ValueError(f"window must be 'consensus' or 'reference', not {window!r}")
+
+    window_steps = {name: with_window(step, start_idx, end_idx) for name, step in steps.items()}
+    valid = {name: resampled[name].valid for name in steps}
+    return SessionAnalysis(time=time, fs=fs, reference=reference, steps=steps, window_steps=window_steps,
+                           valid=valid, start_idx=start_idx, end_idx=end_idx)
+
+
+def _column_mean(x, k):
+    """Mean of column k, summed as a contiguous 1-D array like pandas does"""
+    if len(x) == 0:
+        return np.nan
+    return np.ascontiguousarray(x[:, k]).mean()
@@ -0,0 +1,60 @@
+"""Low pass filtering of multi-channel IMU data
+
+The Butterworth design is cached per (order, cutoff, sample rate rounded to
+FS_RESOLUTION), recordings at practically the same rate share one design.
+Filters are second-order sections, which stay stable at low cutoffs where
+the (b, a) form loses precision.
+
+lowpass() is zero phase (sosfiltfilt) for recorded data, all channels in one
+call. StreamingLowpass is the causal version for live data: blocks of
+samples go in as they arrive and the filter state is carried between them.
+"""
+from functools import lru_cache
+
+import numpy as np
+from scipy.signal import butter, sosfilt, sosfilt_zi, sosfiltfilt
+
+FS_RESOLUTION = 0.1  # Hz, sample rates closer than this share a filter design
+
+
+@lru_cache(maxsize=64)
+def _design(order, cutoff, fs):
+    return butter(N=order, Wn=cutoff / (0.5 * fs), btype='low', output='sos')
+
+
+def lowpass_sos(order, cutoff, fs):
+    """Butterworth low pass as second-order sections, from the cache"""
+    fs = round(fs / FS_RESOLUTION) * FS_RESOLUTION
+    # A copy, scipy wants a writable array and the cached one must not change
+    return _design(int(order), float(cutoff), round(fs, 6)).copy()
+
+
+def lowpass(x, fs, cutoff, order=2, axis=0):
+    """Zero phase low pass of every channel of x along axis"""
+    return sosfiltfilt(lowpass_sos(order, cutoff, fs), x, axis=axis)
+
+
+class StreamingLowpass:
+    """
+    Causal low pass over blocks of (n, channels) samples. The state starts
+    as if the first sample had always been there, so there is no step
+    response at the start
+    """
+
+    def __init__(self, fs, cutoff, order=2, channels=6):
+        self.sos = lowpass_sos(order, cutoff, fs)
+        self.channels = channels
+        self.zi = None
+
+    def process(self, block):
+        block = np.asarray(block, dtype=float).reshape(-1, self.channels)
+        if len(block) == 0:
+            return block
+        if self.zi is None:
+            # (sections, 2, channels) steady state for the first sample
+            self.zi = sosfilt_zi(self.sos)[:, :, np.newaxis] * block[0]
+        filtered, self.zi = sosfilt(self.sos, block, axis=0, zi=self.zi)
+        return filtered
+
+    def reset(self):
+        self.zi = None
@@ -0,0 +1,159 @@
+"""Index of the recorded sessions under csv/
+
+The tree is csv/pN/pN{no,yes}/<session>/imu_<addr>_<bus>.csv, where no/yes
+means without/with glasses. Some sessions were saved inside another
+session folder, those rows have nested=True.
+
+build_index() returns one row per sensor file with patient, intervention,
+session, row count, duration and sample rate. The result is kept in
+csv/manifest.csv, a file is only read again when its mtime or size
+changed, so after the first run the index costs one directory walk.
+
+Patient numbers of the folders are not the real ones (csv/note.txt): one
+patient was skipped after p14, so every folder after p14 is one too high.
+PATIENT_ID_SHIFTS holds that rule, patient_id is the corrected id and
+folder_patient_id the name of the folder.
+"""
+import os
+import re
+import glob
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+ROOT_DIR = "csv"
+MANIFEST_FILE = "manifest.csv"
+SESSION_TIME_FORMAT = "%Y-%m-%d_%H-%M-%S"
+
+# (first folder number the rule applies to, shift), e.g. folder p16 is patient p15
+PATIENT_ID_SHIFTS = [(15, -1)]
+
+COLUMNS = ['patient_id', 'folder_patient_id', 'patient_num', 'intervention_type',
+           'session', 'session_time', 'nested', 'csv_filename', 'csv_path',
+           'addr', 'bus_num', 'rows', 'duration_s', 'sample_rate_hz', 'mtime', 'size']
+
+PATH_PATTERN = re.compile(r"^(p(\d+))$")
+SENSOR_PATTERN = re.compile(r"^imu_(\d+)_(\d+)\.csv$")
+
+
+def remap_patient_num(folder_num):
+    """Real patient number of folder pN"""
+    num = folder_num
+    for first, shift in PATIENT_ID_SHIFTS:
+        if folder_num >= first:
+            num += shift
+    return num
+
+
+def parse_path(csv_path, root_dir=ROOT_DIR):
+    """Index fields that follow from the path alone, None if it is not a sensor file of a session"""
+    parts = os.path.relpath(csv_path, root_dir).split(os.sep)
+    if len(parts) < 4:
+        return None
+    patient_match = PATH_PATTERN.match(parts[0])
+    sensor_match = SENSOR_PATTERN.match(parts[-1])
+    if patient_match is None or sensor_match is None or not parts[1].startswith(parts[0]):
+        return None
+    intervention_type = parts[1][len(parts[0]):]
+    if intervention_type not in ("no", "yes"):
+        return None
+    folder_num = int(patient_match.group(2))
+    patient_num = remap_patient_num(folder_num)
+    session = parts[-2]
+    try:
+        session_time = datetime.strptime(session, SESSION_TIME_FORMAT).isoformat(sep=" ")
+    except ValueError:
+        session_time = None
+    return {
+        'patient_id': f"p{patient_num}",
+        'folder_patient_id': parts[0],
+        'patient_num': patient_num,
+        'intervention_type': intervention_type,
+        'session': session,
+        'session_time': session_time,
+        'nested': len(parts) > 4,
+        'csv_filename': parts[-1],
+        'csv_path': csv_path,
+        'addr': int(sensor_match.group(1)),
+        'bus_num': int(sensor_match.group(2)),
+    }
+
+
+def file_stats(csv_path):
+    """Row count, duration and sample rate from the programtime column"""
+    programtime = pd.read_csv(csv_path, usecols=['programtime'])['programtime'].to_numpy()
+    rows = len(programtime)
+    if rows < 2:
+        return {'rows': rows, 'duration_s': 0.0, 'sample_rate_hz': np.nan}
+    # Older recordings have programtime counting down
+    step = np.median(np.abs(np.diff(programtime)))
+    return {
+        'rows': rows,
+        'duration_s': float(np.ptp(programtime)),
+        'sample_rate_hz': 1 / step if step > 0 else np.nan,
+    }
+
+
+def build_index(root_dir=ROOT_DIR, use_cache=True):
+    """
+    DataFrame with one row per sensor file, sorted by patient,
+    intervention, session time and file name
+    """
+    manifest_path = os.path.join(root_dir, MANIFEST_FILE)
+    cached = {}
+    if use_cache and os.path.isfile(manifest_path):
+        for row in pd.read_csv(manifest_path, float_precision='round_trip').to_dict('records'):
+            cached[row['csv_path']] = row
+
+    rows = []
+    changed = False
+    for csv_path in glob.glob(os.path.join(root_dir, "**", "imu_*.csv"), recursive=True):
+        entry = parse_path(csv_path, root_dir)
+        if entry is None:
+            continue
+        stat = os.stat(csv_path)
+        entry['mtime'] = stat.st_mtime
+        entry['size'] = stat.st_size
+        old = cached.pop(csv_path, None)
+        if old is not None and old['mtime'] == entry['mtime'] and old['size'] == entry['size']:
+            entry.update({key: old[key] for key in ('rows', 'duration_s', 'sample_rate_hz')})
+        else:
+            try:
+                entry.update(file_stats(csv_path))
+            except Exception as e:
+                print(f"Error reading {csv_path}: {e}")
+                continue
+            changed = True
+        rows.append(entry)
+    # Anything left in the cache was deleted or moved
+    changed = changed or bool(cached)
+
+    index = pd.DataFrame(rows, columns=COLUMNS)
+    index = index.sort_values(['patient_num', 'intervention_type', 'session_time', 'session',
+                               'csv_filename'], ignore_index=True)
+    if changed or not os.path.isfile(manifest_path):
+        index.to_csv(manifest_path, index=False)
+    return index
+
+
+def select(index, **criteria):
+    """
+    Rows of the index matching every criterion, a value or a list of
+    values per column, e.g. select(index, patient_id="p3", nested=False)
+    """
+    mask = np.ones(len(index), dtype=bool)
+    for column, value in criteria.items():
+        if isinstance(value, (list, tuple, set)):
+            mask &= index[column].isin(value).to_numpy()
+        else:
+            mask &= (index[column] == value).to_numpy()
+    return index[mask]
+
+
+if __name__ == "__main__":
+    index = build_index()
+    print(index.groupby(['patient_id', 'intervention_type']).agg(
+        sessions=('session', 'nunique'), files=('csv_filename', 'count'),
+        duration_s=('duration_s', 'sum'), sample_rate_hz=('sample_rate_hz', 'median')).to_string())
+    print(f"{len(index)} files, {index['rows'].sum()} rows, "
+          f"{index['duration_s'].sum() / 60:.1f} min recorded")
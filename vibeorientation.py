@@ -0,0 +1,216 @@
+"""Offline orientation estimation (Madgwick / Mahony) over whole recordings
+
+The filters take a full (N, 3) gyroscope array in rad/s and a full (N, 3)
+accelerometer array (any unit, it is normalised) and return an (N, 4)
+quaternion array [q0, q1, q2, q3]. Several sensors of the same length can
+be processed at once by passing (S, N, 3) arrays, the update is then
+vectorised across sensors. When numba is installed the time loop is
+compiled.
+
+Running this file recomputes q0..q3 for every CSV under ROOT_DIR and
+writes them to the same relative path under OUTPUT_DIR.
+"""
+import os
+import glob
+import numpy as np
+import pandas as pd
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# --- Constants ---
+GYRO_SENSITIVITY_LSB_PER_DPS = 131
+
+ROOT_DIR = "csv"
+OUTPUT_DIR = "orientation"
+METHOD = "madgwick"
+GAINS = {}  # e.g. {"beta": 0.1} for madgwick, {"k_p": 1.0, "k_i": 0.3} for mahony
+
+
+def _madgwick_loop(gyr, acc, dt, beta, q):
+    """Madgwick IMU update, gyr/acc (S, N, 3), dt (S, N), q (S, 4) start quaternion"""
+    n_samples = gyr.shape[1]
+    out = np.empty((gyr.shape[0], n_samples, 4))
+    q0 = q[:, 0].copy()
+    q1 = q[:, 1].copy()
+    q2 = q[:, 2].copy()
+    q3 = q[:, 3].copy()
+    for n in range(n_samples):
+        gx = gyr[:, n, 0]
+        gy = gyr[:, n, 1]
+        gz = gyr[:, n, 2]
+        # Rate of change of the quaternion from the gyroscope
+        qd0 = 0.5 * (-q1 * gx - q2 * gy - q3 * gz)
+        qd1 = 0.5 * (q0 * gx + q2 * gz - q3 * gy)
+        qd2 = 0.5 * (q0 * gy - q1 * gz + q3 * gx)
+        qd3 = 0.5 * (q0 * gz + q1 * gy - q2 * gx)
+
+        # Gradient descent correction towards the measured gravity
+        a_norm = np.sqrt(acc[:, n, 0] ** 2 + acc[:, n, 1] ** 2 + acc[:, n, 2] ** 2)
+        valid = a_norm > 0
+        a_norm = np.where(valid, a_norm, 1.0)
+        ax = acc[:, n, 0] / a_norm
+        ay = acc[:, n, 1] / a_norm
+        az = acc[:, n, 2] / a_norm
+        f0 = 2.0 * (q1 * q3 - q0 * q2) - ax
+        f1 = 2.0 * (q0 * q1 + q2 * q3) - ay
+        f2 = 2.0 * (0.5 - q1 * q1 - q2 * q2) - az
+        s0 = -2.0 * q2 * f0 + 2.0 * q1 * f1
+        s1 = 2.0 * q3 * f0 + 2.0 * q0 * f1 - 4.0 * q1 * f2
+        s2 = -2.0 * q0 * f0 + 2.0 * q3 * f1 - 4.0 * q2 * f2
+        s3 = 2.0 * q1 * f0 + 2.0 * q2 * f1
+        s_norm = np.sqrt(s0 * s0 + s1 * s1 + s2 * s2 + s3 * s3)
+        valid = valid & (s_norm > 0)
+        step = np.where(valid, beta / np.where(valid, s_norm, 1.0), 0.0)
+        qd0 = qd0 - step * s0
+        qd1 = qd1 - step * s1
+        qd2 = qd2 - step * s2
+        qd3 = qd3 - step * s3
+
+        q0 = q0 + qd0 * dt[:, n]
+        q1 = q1 + qd1 * dt[:, n]
+        q2 = q2 + qd2 * dt[:, n]
+        q3 = q3 + qd3 * dt[:, n]
+        q_norm = np.sqrt(q0 * q0 + q1 * q1 + q2 * q2 + q3 * q3)
+        q0 = q0 / q_norm
+        q1 = q1 / q_norm
+        q2 = q2 / q_norm
+        q3 = q3 / q_norm
+        out[:, n, 0] = q0
+        out[:, n, 1] = q1
+        out[:, n, 2] = q2
+        out[:, n, 3] = q3
+    return out
+
+
+def _mahony_loop(gyr, acc, dt, k_p, k_i, q):
+    """Mahony IMU update, same layout as _madgwick_loop"""
+    n_samples = gyr.shape[1]
+    out = np.empty((gyr.shape[0], n_samples, 4))
+    q0 = q[:, 0].copy()
+    q1 = q[:, 1].copy()
+    q2 = q[:, 2].copy()
+    q3 = q[:, 3].copy()
+    bx = np.zeros(gyr.shape[0])
+    by = np.zeros(gyr.shape[0])
+    bz = np.zeros(gyr.shape[0])
+    for n in range(n_samples):
+        a_norm = np.sqrt(acc[:, n, 0] ** 2 + acc[:, n, 1] ** 2 + acc[:, n, 2] ** 2)
+        valid = a_norm > 0
+        a_norm = np.where(valid, a_norm, 1.0)
+        ax = acc[:, n, 0] / a_norm
+        ay = acc[:, n, 1] / a_norm
+        az = acc[:, n, 2] / a_norm
+
+        # Gravity direction from the current estimate and its error to the measurement
+        vx = 2.0 * (q1 * q3 - q0 * q2)
+        vy = 2.0 * (q0 * q1 + q2 * q3)
+        vz = q0 * q0 - q1 * q1 - q2 * q2 + q3 * q3
+        ex = np.where(valid, ay * vz - az * vy, 0.0)
+        ey = np.where(valid, az * vx - ax * vz, 0.0)
+        ez = np.where(valid, ax * vy - ay * vx, 0.0)
+
+        bx = bx - k_i * ex * dt[:, n]
+        by = by - k_i * ey * dt[:, n]
+        bz = bz - k_i * ez * dt[:, n]
+        gx = gyr[:, n, 0] - bx + k_p * ex
+        gy = gyr[:, n, 1] - by + k_p * ey
+        gz = gyr[:, n, 2] - bz + k_p * ez
+
+        qd0 = 0.5 * (-q1 * gx - q2 * gy - q3 * gz)
+        qd1 = 0.5 * (q0 * gx + q2 * gz - q3 * gy)
+        qd2 = 0.5 * (q0 * gy - q1 * gz + q3 * gx)
+        qd3 = 0.5 * (q0 * gz + q1 * gy - q2 * gx)
+        q0 = q0 + qd0 * dt[:, n]
+        q1 = q1 + qd1 * dt[:, n]
+        q2 = q2 + qd2 * dt[:, n]
+        q3 = q3 + qd3 * dt[:, n]
+        q_norm = np.sqrt(q0 * q0 + q1 * q1 + q2 * q2 + q3 * q3)
+        q0 = q0 / q_norm
+        q1 = q1 / q_norm
+        q2 = q2 / q_norm
+        q3 = q3 / q_norm
+        out[:, n, 0] = q0
+        out[:, n, 1] = q1
+        out[:, n, 2] = q2
+        out[:, n, 3] = q3
+    return out
+
+
+if numba is not None:
+    _madgwick_loop = numba.njit(cache=True)(_madgwick_loop)
+    _mahony_loop = numba.njit(cache=True)(_mahony_loop)
+
+
+def _prepare(gyr, acc, dt, q0):
+    """Brings the inputs to (S, N, 3) / (S, N) / (S, 4) float arrays"""
+    gyr = np.asarray(gyr, dtype=float)
+    acc = np.asarray(acc, dtype=float)
+    single = gyr.ndim == 2
+    if single:
+        gyr = gyr[np.newaxis]
+        acc = acc[np.newaxis]
+    if gyr.shape != acc.shape or gyr.shape[-1] != 3:
+        raise ValueError(f"gyr {gyr.shape} and acc {acc.shape} must both be (N, 3) or (S, N, 3)")
+    n_sensors, n_samples = gyr.shape[:2]
+
+    dt = np.broadcast_to(np.asarray(dt, dtype=float), (n_sensors, n_samples)).copy()
+    if q0 is None:
+        q0 = [1.0, 0.0, 0.0, 0.0]
+    q0 = np.broadcast_to(np.asarray(q0, dtype=float), (n_sensors, 4)).copy()
+    return np.ascontiguousarray(gyr), np.ascontiguousarray(acc), dt, q0, single
+
+
+def madgwick(gyr, acc, dt, beta=0.033, q0=None):
+    """
+    Madgwick orientation for a whole recording.
+    gyr in rad/s, dt in seconds (scalar, per sample or per sensor and sample),
+    returns (N, 4) quaternions, or (S, N, 4) for (S, N, 3) input
+    """
+    gyr, acc, dt, q0, single = _prepare(gyr, acc, dt, q0)
+    out = _madgwick_loop(gyr, acc, dt, float(beta), q0)
+    return out[0] if single else out
+
+
+def mahony(gyr, acc, dt, k_p=1.0, k_i=0.3, q0=None):
+    """
+    Mahony orientation for a whole recording, same arguments as madgwick
+    """
+    gyr, acc, dt, q0, single = _prepare(gyr, acc, dt, q0)
+    out = _mahony_loop(gyr, acc, dt, float(k_p), float(k_i), q0)
+    return out[0] if single else out
+
+
+def orientation_from_csv(df, method=METHOD, **gains):
+    """
+    Recomputes q0..q3 for one IMU CSV (raw LSB columns as written by UDPLaptop.py)
+    """
+    programtime = df['programtime'].to_numpy(dtype=float)
+    dt = np.abs(np.diff(programtime))
+    dt = np.concatenate([[np.median(dt) if len(dt) else 0.0], dt])
+    gyr = np.radians(df[['gx', 'gy', 'gz']].to_numpy(dtype=float) / GYRO_SENSITIVITY_LSB_PER_DPS)
+    acc = df[['ax', 'ay', 'az']].to_numpy(dtype=float)
+
+    if method == "madgwick":
+        q = madgwick(gyr, acc, dt, **gains)
+    elif method == "mahony":
+        q = mahony(gyr, acc, dt, **gains)
+    else:
+        raise ValueError(f"Unknown method {method!r}")
+    return pd.DataFrame({'programtime': programtime,
+                         'q0': q[:, 0], 'q1': q[:, 1], 'q2': q[:, 2], 'q3': q[:, 3]})
+
+
+if __name__ == "__main__":
+    for csv_path in sorted(glob.glob(os.path.join(ROOT_DIR, "**", "imu_*.csv"), recursive=True)):
+        out_path = os.path.join(OUTPUT_DIR, os.path.relpath(csv_path, ROOT_DIR))
+        try:
+            orientation = orientation_from_csv(pd.read_csv(csv_path), METHOD, **GAINS)
+        except Exception as e:
+            print(f"Error processing {csv_path}: {e}")
+            continue
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+        orientation.to_csv(out_path, index=False)
+        print(f"{csv_path} -> {out_path}")
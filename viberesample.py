@@ -0,0 +1,123 @@
+"""Resampling of IMU recordings onto a uniform time grid
+
+Samples arrive over UDP with jitter and sometimes with gaps, while the step
+analysis counts windows and peak distances in samples. resample() puts one
+stream on an exact grid of 1/fs steps by linear interpolation. Grid points
+inside a gap longer than max_gap are still filled (so filters can run over
+them) but marked invalid in the mask.
+
+align() puts several streams, e.g. the IMUs of one session, on one shared
+grid, so that row i is the same moment for every sensor.
+
+Older recordings have programtime counting down (start minus now), the
+sensors of one session share that clock. timeline() turns it into a time
+counting up without shifting it, so streams stay comparable.
+"""
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+MAX_GAP = 0.1  # s, longer gaps are not interpolated over (marked invalid)
+RAW_COLUMNS = ['ax', 'ay', 'az', 'gx', 'gy', 'gz']
+
+Resampled = namedtuple('Resampled', ['time', 'values', 'valid'])
+
+
+def timeline(programtime):
+    """Session time in s counting up, same clock for all sensors of a session"""
+    programtime = np.asarray(programtime, dtype=float)
+    if len(programtime) > 1 and programtime[-1] < programtime[0]:
+        return -programtime
+    return programtime.copy()
+
+
+def clean(time, values):
+    """Sorted by time, repeated timestamps dropped (the first one is kept)"""
+    order = np.argsort(time, kind='stable')
+    time, values = time[order], values[order]
+    keep = np.concatenate(([True], np.diff(time) > 0))
+    return time[keep], values[keep]
+
+
+def estimate_fs(time):
+    """Sample rate from the median interval, robust against gaps and jitter"""
+    return 1 / np.median(np.diff(time))
+
+
+def detect_gaps(time, max_gap=MAX_GAP):
+    """(k, 2) array of [last sample before, first sample after] for every gap longer than max_gap"""
+    intervals = np.diff(time)
+    starts = np.flatnonzero(intervals > max_gap)
+    return np.column_stack([time[starts], time[starts + 1]])
+
+
+def uniform_grid(start, end, fs):
+    """start, start + 1/fs, ... up to and including end"""
+    n = int(np.floor((end - start) * fs + 1e-9)) + 1
+    return start + np.arange(max(n, 0)) / fs
+
+
+def interpolate(time, values, grid, max_gap=MAX_GAP):
+    """
+    values (N, C) at sorted, unique time linearly interpolated to grid.
+    Grid points outside time or inside a gap longer than max_gap are invalid,
+    outside they hold the first/last sample
+    """
+    values = np.asarray(values, dtype=float).reshape(len(time), -1)
+    if len(time) < 2:
+        return Resampled(grid, np.repeat(values[:1], len(grid), axis=0), np.zeros(len(grid), dtype=bool))
+    left = np.clip(np.searchsorted(time, grid, side='right') - 1, 0, len(time) - 2)
+    t0, t1 = time[left], time[left + 1]
+    weight = np.clip((grid - t0) / (t1 - t0), 0.0, 1.0)[:, np.newaxis]
+    resampled = values[left] * (1 - weight) + values[left + 1] * weight
+    # A grid point on a sample belongs to the intervals on both sides of it,
+    # it is only in a gap if both are gaps (else the last sample before a
+    # gap would be marked invalid)
+    right = np.clip(np.searchsorted(time, grid, side='left'), 1, len(time) - 1)
+    in_gap = (t1 - t0 > max_gap) & (time[right] - time[right - 1] > max_gap)
+    valid = (grid >= time[0]) & (grid <= time[-1]) & ~in_gap
+    return Resampled(grid, resampled, valid)
+
+
+def resample(time, values, fs=None, max_gap=MAX_GAP):
+    """One stream on a uniform grid from its first to its last sample, fs estimated if not given"""
+    time, values = clean(np.asarray(time, dtype=float), np.asarray(values))
+    if fs is None:
+        fs = estimate_fs(time)
+    return interpolate(time, values, uniform_grid(time[0], time[-1], fs), max_gap)
+
+
+def align(streams, fs=None, max_gap=MAX_GAP, span='overlap'):
+    """
+    {name: (time, values)} on one shared grid, returns (grid, {name: Resampled}).
+    span 'overlap' covers the time all streams have data, 'union' the time any
+    of them has (outside its own recording a stream is invalid). fs is the
+    median rate of the streams if not given
+    """
+    cleaned = {name: clean(np.asarray(time, dtype=float), np.asarray(values))
+               for name, (time, values) in streams.items()}
+    if fs is None:
+        fs = np.median([estimate_fs(time) for time, _ in cleaned.values()])
+    starts = [time[0] for time, _ in cleaned.values()]
+    ends = [time[-1] for time, _ in cleaned.values()]
+    if span == 'overlap':
+        grid = uniform_grid(max(starts), min(ends), fs)
+    elif span == 'union':
+        grid = uniform_grid(min(starts), max(ends), fs)
+    else:
+        raise ValueError(f"span must be 'overlap' or 'union', not {span!r}")
+    return grid, {name: interpolate(time, values, grid, max_gap) for name, (time, values) in cleaned.items()}
+
+
+def read_stream(csv_path, columns=RAW_COLUMNS):
+    """(session time, values (N, C)) of one sensor CSV, time as in timeline()"""
+    df = pd.read_csv(csv_path)
+    return timeline(df['programtime'].to_numpy()), df[columns].to_numpy(dtype=float)
+
+
+def read_uniform(csv_path, fs=None, max_gap=MAX_GAP, columns=RAW_COLUMNS):
+    """One sensor CSV resampled, time starting at 0"""
+    time, values = read_stream(csv_path, columns)
+    resampled = resample(time, values, fs, max_gap)
+    return resampled._replace(time=resampled.time - resampled.time[0])
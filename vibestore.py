@@ -0,0 +1,195 @@
+"""Compressed binary session storage next to the per-IMU CSVs
+
+One session folder (csv/pN/pN{no,yes}/<timestamp>/) becomes one
+session.npz holding every IMU stream as typed columns:
+
+    <stream>/programtime, <stream>/sendertime    float64 seconds
+    <stream>/ax .. <stream>/gz                   int16 raw LSB
+    <stream>/q0 .. <stream>/q3                   float32
+
+plus a JSON metadata record (patient, intervention, session, sensor map).
+np.load reads a single column without touching the others.
+
+The file is written one column at a time, so memory use is that of the
+largest column, not of the session. convert_captures() builds it straight
+from the memory-mapped capture files of UDPLaptop.py (IMUCapture.py)
+without parsing any CSV.
+
+Running this file converts every session under ROOT_DIR that has no
+session.npz yet or whose CSVs changed since.
+"""
+import os
+import glob
+import json
+import zipfile
+from collections.abc import Mapping
+import numpy as np
+import pandas as pd
+
+import IMUCapture
+import vibeindex
+
+ROOT_DIR = "csv"
+SESSION_FILE = "session.npz"
+
+COLUMN_TYPES = {
+    'programtime': np.float64,
+    'sendertime': np.float64,
+    'ax': np.int16, 'ay': np.int16, 'az': np.int16,
+    'gx': np.int16, 'gy': np.int16, 'gz': np.int16,
+    'q0': np.float32, 'q1': np.float32, 'q2': np.float32, 'q3': np.float32,
+}
+METADATA_KEY = "__metadata__"
+
+
+class CaptureColumns(Mapping):
+    """The records of one capture file as columns, each read when it is asked for"""
+
+    def __init__(self, records):
+        self.records = records
+
+    def __getitem__(self, column):
+        if column == 'sendertime':
+            return self.records['sendertime_ns'] / 1e9
+        if column not in COLUMN_TYPES or column not in self.records.dtype.names:
+            raise KeyError(column)
+        return self.records[column]
+
+    def __iter__(self):
+        return (column for column in COLUMN_TYPES if column in self)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __contains__(self, column):
+        return column == 'sendertime' or (column in COLUMN_TYPES and column in self.records.dtype.names)
+
+
+def write_session(path, streams, metadata=None):
+    """
+    Stores {stream name: DataFrame or other column mapping} in one
+    compressed npz file, only the columns in COLUMN_TYPES are kept.
+    Every column is converted and written on its own
+    """
+    metadata = dict(metadata or {})
+    metadata['streams'] = sorted(streams)
+    # What np.savez_compressed does, but without holding every array at once
+    with zipfile.ZipFile(path, mode='w', compression=zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
+        for name, df in streams.items():
+            for column, dtype in COLUMN_TYPES.items():
+                if column not in df:
+                    continue
+                values = np.asarray(df[column])
+                if np.issubdtype(dtype, np.integer) and not np.issubdtype(values.dtype, np.integer):
+                    values = np.round(values)
+                _write_array(zf, f"{name}/{column}", values.astype(dtype))
+        _write_array(zf, METADATA_KEY, np.array(json.dumps(metadata)))
+
+
+def _write_array(zf, key, values):
+    with zf.open(f"{key}.npy", mode='w', force_zip64=True) as f:
+        np.lib.format.write_array(f, values, allow_pickle=False)
+
+
+def read_metadata(path):
+    with np.load(path) as data:
+        return json.loads(str(data[METADATA_KEY]))
+
+
+def read_session(path, streams=None, columns=None):
+    """
+    Returns (metadata, {stream name: DataFrame}),
+    optionally only for some streams and/or columns
+    """
+    result = {}
+    with np.load(path) as data:
+        metadata = json.loads(str(data[METADATA_KEY]))
+        for name in metadata['streams']:
+            if streams is not None and name not in streams:
+                continue
+            result[name] = pd.DataFrame({
+                column: data[f"{name}/{column}"]
+                for column in COLUMN_TYPES
+                if (columns is None or column in columns) and f"{name}/{column}" in data.files
+            })
+    return metadata, result
+
+
+def session_metadata(session_folder, root_dir=ROOT_DIR):
+    """
+    Patient (corrected like vibeindex.py, plus the folder name),
+    intervention and session name from the folder layout
+    csv/pN/pN{no,yes}/<session>/, plus the sensor map of the CSV and capture files in it
+    """
+    metadata = {'session': os.path.basename(os.path.normpath(session_folder))}
+    parts = os.path.relpath(session_folder, root_dir).split(os.sep)
+    patient_match = vibeindex.PATH_PATTERN.match(parts[0])
+    if len(parts) >= 3 and patient_match is not None and parts[1].startswith(parts[0]):
+        # The corrected patient id, as in the index and the metrics summaries
+        metadata['patient_id'] = f"p{vibeindex.remap_patient_num(int(patient_match.group(2)))}"
+        metadata['folder_patient_id'] = parts[0]
+        metadata['intervention_type'] = parts[1][len(parts[0]):]
+    sensors = {}
+    for path in sorted(glob.glob(os.path.join(session_folder, "imu_*.csv")) +
+                       glob.glob(os.path.join(session_folder, "imu_*.imu"))):
+        name = os.path.splitext(os.path.basename(path))[0]
+        _, addr, bus_num = name.split("_")
+        sensors[name] = {'addr': int(addr), 'bus_num': int(bus_num)}
+    metadata['sensors'] = sensors
+    return metadata
+
+
+def convert_session(session_folder, root_dir=ROOT_DIR, force=False):
+    """
+    Writes session.npz for the imu_*.csv files of one folder, skipped when
+    it is newer than all of them. Returns the path or None if nothing to do
+    """
+    csv_paths = sorted(glob.glob(os.path.join(session_folder, "imu_*.csv")))
+    if not csv_paths:
+        return None
+    path = os.path.join(session_folder, SESSION_FILE)
+    if not force and os.path.exists(path) and \
+            os.path.getmtime(path) >= max(os.path.getmtime(p) for p in csv_paths):
+        return None
+    streams = {os.path.splitext(os.path.basename(p))[0]: pd.read_csv(p) for p in csv_paths}
+    write_session(path, streams, session_metadata(session_folder, root_dir))
+    return path
+
+
+def convert_captures(session_folder, root_dir=ROOT_DIR):
+    """
+    Writes session.npz from the imu_*.imu capture files of one folder,
+    reading the mapped records one column at a time. Returns the path or
+    None if there are no captures
+    """
+    capture_paths = sorted(glob.glob(os.path.join(session_folder, "imu_*.imu")))
+    if not capture_paths:
+        return None
+    streams = {}
+    for capture_path in capture_paths:
+        _, records = IMUCapture.open_capture(capture_path)
+        streams[os.path.splitext(os.path.basename(capture_path))[0]] = CaptureColumns(records)
+    path = os.path.join(session_folder, SESSION_FILE)
+    write_session(path, streams, session_metadata(session_folder, root_dir))
+    return path
+
+
+def convert_tree(root_dir=ROOT_DIR, force=False):
+    """Converts every folder under root_dir that holds imu_*.csv files"""
+    folders = sorted({os.path.dirname(p) for p in
+                      glob.glob(os.path.join(root_dir, "**", "imu_*.csv"), recursive=True)})
+    converted = []
+    for folder in folders:
+        try:
+            path = convert_session(folder, root_dir, force)
+        except Exception as e:
+            print(f"Error converting {folder}: {e}")
+            continue
+        if path is not None:
+            print(f"{folder} -> {path}")
+            converted.append(path)
+    return converted
+
+
+if __name__ == "__main__":
+    convert_tree()